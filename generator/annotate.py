@@ -0,0 +1,148 @@
+"""
+Fills the missing evals of a game cache with a shallow fixed-node engine pass, so that the generator
+can look for swings in the games nobody had analysed, the large majority of a dump.
+Candidates found this way are still verified at the usual engine limits.
+
+Each game is analysed by one engine from start to end, keeping its hash from one ply to the next.
+Games are spread over a pool of engines and written back in their original order:
+
+    python3 annotate.py -f 2022-08.pgc -o 2022-08-annotated.pgc --engines 8 --nodes 20000
+"""
+import argparse
+import logging
+import queue
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from chess import WHITE
+from chess.engine import Limit, INFO_SCORE
+from typing import Deque, Iterable, Iterator, List, Tuple
+from gamecache import GameCache, MAGIC, write_record
+from mainline import Mainline, MATE_BASE, NO_EVAL, encode_eval
+from supervisor import Engine
+from util import decode_move
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+def needs_evals(mainline: Mainline) -> bool:
+    return NO_EVAL in mainline.evals
+
+def annotate_game(engine: Engine, mainline: Mainline, limit: Limit) -> int:
+    """
+    fills the missing evals of `mainline` in place, returns how many positions were analysed
+    """
+    board = mainline.board()
+    analysed = 0
+    for ply, code in enumerate(mainline.moves):
+        board.push(decode_move(code))
+        if mainline.evals[ply] != NO_EVAL:
+            continue
+        if board.is_checkmate():
+            mainline.evals[ply] = -MATE_BASE if board.turn == WHITE else MATE_BASE
+        elif board.is_game_over():
+            mainline.evals[ply] = 0
+        else:
+            # the same game keeps the engine from clearing its hash
+            info = engine.analyse(board, limit, game = mainline.game_id(), info = INFO_SCORE)
+            mainline.evals[ply] = encode_eval(info.get("score"))
+            analysed += 1
+    return analysed
+
+
+class Annotator:
+    """
+    Annotates games on a pool of engines, one game per engine at a time,
+    yielding them back in the order they came in
+    """
+
+    def __init__(self, engines: List[Engine], limit: Limit, in_flight: int = 0) -> None:
+        self.engines = engines
+        self.limit = limit
+        self.idle: "queue.Queue[Engine]" = queue.Queue()
+        for engine in engines:
+            self.idle.put(engine)
+        self.in_flight = in_flight or 4 * len(engines)
+        self.executor = ThreadPoolExecutor(len(engines), thread_name_prefix = "annotator")
+        self.games = 0
+        self.positions = 0
+
+    def annotate(self, mainline: Mainline) -> Mainline:
+        engine = self.idle.get()
+        try:
+            self.positions += annotate_game(engine, mainline, self.limit)
+            self.games += 1
+            return mainline
+        finally:
+            self.idle.put(engine)
+
+    def annotate_all(self, games: Iterable[Tuple[int, Mainline]]) -> Iterator[Tuple[int, Mainline]]:
+        pending: Deque[Tuple[int, "Future[Mainline]"]] = deque()
+        for tier, mainline in games:
+            if not needs_evals(mainline):
+                # no engine needed, but the order is kept
+                done: "Future[Mainline]" = Future()
+                done.set_result(mainline)
+                pending.append((tier, done))
+            else:
+                pending.append((tier, self.executor.submit(self.annotate, mainline)))
+            while len(pending) >= self.in_flight or (pending and pending[0][1].done()):
+                tier, future = pending.popleft()
+                yield tier, future.result()
+        while pending:
+            tier, future = pending.popleft()
+            yield tier, future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for engine in self.engines:
+            engine.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='annotate.py',
+        description='fills the missing evals of a game cache with a shallow engine pass')
+    parser.add_argument("--file", "-f", help="game cache written by gamecache.py", required=True, metavar="FILE.pgc")
+    parser.add_argument("--output", "-o", help="annotated game cache to write", required=True, metavar="FILE.pgc")
+    parser.add_argument("--engine", "-e", help="analysis engine", default="./stockfish")
+    parser.add_argument("--engines", help="count of engines annotating games in parallel", default="4")
+    parser.add_argument("--threads", "-t", help="count of cpu threads of each engine", default="1")
+    parser.add_argument("--hash", help="hash table size of each engine in MB", default="64")
+    parser.add_argument("--nodes", help="engine nodes per position", default="20000")
+    parser.add_argument("--min-tier", help="leave out the games without evals of a lower header tier", default="0")
+    return parser.parse_args()
+
+
+def main() -> None:
+    from generator import make_engine
+    args = parse_args()
+    logger.setLevel(logging.INFO)
+    engines: List[Engine] = [make_engine(args.engine, int(args.threads), int(args.hash)) for _ in range(int(args.engines))]
+    annotator = Annotator(engines, Limit(nodes = int(args.nodes)))
+    min_tier = int(args.min_tier)
+    skipped = 0
+
+    def games() -> Iterator[Tuple[int, Mainline]]:
+        nonlocal skipped
+        for (_, tier), mainline in GameCache(args.file):
+            if tier < min_tier and needs_evals(mainline):
+                skipped += 1
+                continue
+            yield tier, mainline
+
+    written = 0
+    try:
+        with open(args.output, "wb") as out:
+            out.write(MAGIC)
+            for tier, mainline in annotator.annotate_all(games()):
+                write_record(out, tier, mainline)
+                written += 1
+                if written % 1000 == 0:
+                    logger.info(f"{written} games written, {annotator.games} annotated, {annotator.positions} positions analysed")
+    finally:
+        annotator.close()
+    logger.info(f"Wrote {written} games to {args.output}: {annotator.games} annotated with {annotator.positions} positions, {skipped} below tier {min_tier} left out")
+
+
+if __name__ == "__main__":
+    main()
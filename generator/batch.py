@@ -0,0 +1,130 @@
+import argparse
+import glob
+import logging
+import os
+import time
+import workerpool
+from dataclasses import dataclass
+from typing import List, Optional, Set, Tuple, TYPE_CHECKING
+from workerpool import worker_pool
+
+if TYPE_CHECKING:
+    from generator import Generator
+    from memory import MemoryReport
+    from server import Server
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Job:
+    file: str
+    part: int
+    parts: int
+    size: int # approximate bytes of the dump this part covers
+
+    def key(self) -> Tuple[str, int, int]:
+        return (os.path.abspath(self.file), self.part, self.parts)
+
+@dataclass
+class JobResult:
+    job: Job
+    games: int
+    puzzles: int
+    seconds: float
+    error: Optional[str] = None
+
+
+class Ledger:
+    """
+    Append-only record of completed (file, part, parts) jobs, one tab separated line each:
+    version, file, part, parts, games, puzzles, seconds
+    """
+
+    def __init__(self, path: str, version: int) -> None:
+        self.path = path
+        self.version = version
+        self.done: Set[Tuple[str, int, int]] = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) >= 4 and fields[0] == str(version):
+                        self.done.add((fields[1], int(fields[2]), int(fields[3])))
+
+    def is_done(self, job: Job) -> bool:
+        return job.key() in self.done
+
+    def record(self, result: JobResult) -> None:
+        file, part, parts = result.job.key()
+        with open(self.path, "a") as f:
+            f.write(f"{self.version}\t{file}\t{part}\t{parts}\t{result.games}\t{result.puzzles}\t{round(result.seconds)}\n")
+        self.done.add(result.job.key())
+
+
+def list_jobs(pattern: str, parts: int) -> List[Job]:
+    jobs = []
+    for file in sorted(glob.glob(pattern)):
+        size = os.path.getsize(file) // parts
+        jobs.extend(Job(file, part, parts, size) for part in range(1, parts + 1))
+    # largest dumps first, so that the small ones fill the gaps at the end of the run
+    return sorted(jobs, key = lambda job: -job.size)
+
+
+def make_worker(args: argparse.Namespace, version: int) -> Tuple["Generator", "Server", Optional["MemoryReport"]]:
+    from generator import make_generator, logger as generator_logger
+    from server import Server
+    from memory import MemoryReport
+    from profiler import Profiler
+    Profiler(control_file = args.profile_control).install()
+    generator_logger.setLevel(logger.level)
+    server = Server(generator_logger, args.url, args.token, version)
+    memory = MemoryReport(generator_logger, int(args.memory_report)) if int(args.memory_report) else None
+    return (make_generator(args, server), server, memory)
+
+def run_job(job: Job) -> JobResult:
+    from generator import process_file
+    assert workerpool.worker
+    generator, server, memory = workerpool.worker
+    start = time.time()
+    try:
+        games, puzzles = process_file(generator, server, job.file, job.part, job.parts, memory = memory)
+        # a pool worker has no exit hook, its totals so far are logged after each job instead
+        generator.rejections.report()
+        return JobResult(job, games, puzzles, time.time() - start)
+    except Exception as e:
+        return JobResult(job, 0, 0, time.time() - start, str(e))
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}h{minutes % 60:02d}m"
+
+def run_batch(args: argparse.Namespace, version: int) -> None:
+    logger.setLevel(logging.DEBUG if args.verbose == 2 else logging.INFO)
+    ledger = Ledger(args.ledger, version)
+    jobs = [job for job in list_jobs(args.input_glob, int(args.parts)) if not ledger.is_done(job)]
+    workers = int(args.workers)
+    total_bytes = sum(job.size for job in jobs) or 1
+    logger.info(f"v{version} {len(jobs)} file parts to process with {workers} workers, {len(ledger.done)} already done")
+
+    done_bytes = 0
+    games = 0
+    puzzles = 0
+    start = time.time()
+    with worker_pool(workers, make_worker, args, version) as pool:
+        for i, result in enumerate(pool.imap_unordered(run_job, jobs, chunksize = 1), 1):
+            job = result.job
+            if result.error:
+                logger.error(f"{job.file} {job.part}/{job.parts} failed: {result.error}")
+                continue
+            ledger.record(result)
+            done_bytes += job.size
+            games += result.games
+            puzzles += result.puzzles
+            elapsed = time.time() - start
+            eta = elapsed * (total_bytes - done_bytes) / max(done_bytes, 1)
+            logger.info(
+                f"{job.file} {job.part}/{job.parts} done in {format_duration(result.seconds)}: {result.puzzles} puzzles. "
+                f"Total {i}/{len(jobs)} parts, {round(100 * done_bytes / total_bytes)}%, "
+                f"{games} games, {puzzles} puzzles, ETA {format_duration(eta)}"
+            )
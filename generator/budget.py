@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+import chess
+import chess.engine
+from dataclasses import dataclass
+from chess.engine import Limit, InfoDict, PlayResult
+from typing import Any, List, Optional, Union
+from supervisor import Engine
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Allowance:
+    time: Optional[float] = None # seconds
+    nodes: Optional[int] = None
+
+    def is_limited(self) -> bool:
+        return self.time is not None or self.nodes is not None
+
+@dataclass
+class Budget:
+    scope: str
+    allowance: Allowance
+    time: float = 0
+    nodes: int = 0
+
+    def is_exhausted(self) -> bool:
+        return (
+            (self.allowance.time is not None and self.time >= self.allowance.time) or
+            (self.allowance.nodes is not None and self.nodes >= self.allowance.nodes)
+        )
+
+    def fits(self, limit: Limit) -> bool:
+        """
+        whether what is left of this budget covers a search running to its full `limit`
+        """
+        return not (
+            (self.allowance.time is not None and limit.time is not None and self.time + limit.time > self.allowance.time) or
+            (self.allowance.nodes is not None and limit.nodes is not None and self.nodes + limit.nodes > self.allowance.nodes)
+        )
+
+class BudgetExceeded(Exception):
+    def __init__(self, budget: Budget) -> None:
+        super().__init__(f"{budget.scope} budget exceeded: {budget.nodes} nodes, {round(budget.time)}s")
+        self.budget = budget
+
+
+class BudgetManager:
+    """
+    Engine allowances of the game being analysed and of the candidate being probed.
+    A search their remainders can't cover up to its full limit raises BudgetExceeded instead
+    of running cut short. Abandonments are appended to `log_path` (game id, ply, scope, nodes, seconds)
+    so they can be retried with a bigger budget.
+    """
+
+    def __init__(self, game: Allowance, candidate: Allowance, log_path: Optional[str] = None) -> None:
+        self.game_allowance = game
+        self.candidate_allowance = candidate
+        self.log_path = log_path
+        self.game = Budget("game", game)
+        self.candidate: Optional[Budget] = None
+        self.total = Budget("total", Allowance())
+        # speculative searches are charged from their own thread
+        self.lock = threading.Lock()
+
+    def start_game(self) -> None:
+        self.game = Budget("game", self.game_allowance)
+        self.candidate = None
+
+    def start_candidate(self) -> None:
+        self.candidate = Budget("candidate", self.candidate_allowance)
+
+    def check(self, limit: Optional[Limit] = None) -> None:
+        for budget in [self.game, self.candidate]:
+            if budget and (budget.is_exhausted() or (limit and not budget.fits(limit))):
+                raise BudgetExceeded(budget)
+
+    def current(self) -> List[Budget]:
+        return [budget for budget in [self.game, self.candidate, self.total] if budget]
+
+    def charge(self, nodes: int, seconds: float, budgets: Optional[List[Budget]] = None) -> None:
+        """
+        charges the current budgets, or `budgets` taken when a search started
+        """
+        with self.lock:
+            for budget in self.current() if budgets is None else budgets:
+                budget.nodes += nodes
+                budget.time += seconds
+
+    def abandon(self, game_id: str, ply: int, e: BudgetExceeded) -> None:
+        logger.warning(f"Abandoning {game_id}#{ply}: {e}")
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(f"{game_id}\t{ply}\t{e.budget.scope}\t{e.budget.nodes}\t{round(e.budget.time, 1)}\n")
+
+
+def info_nodes(info: Union[InfoDict, List[InfoDict]]) -> int:
+    first = info[0] if isinstance(info, list) else info
+    return first.get("nodes", 0) if first else 0
+
+class BudgetedEngine:
+    """
+    Runs the searches of the wrapped engine that the current budgets cover and charges them against those
+    """
+
+    def __init__(self, engine: Engine, budgets: BudgetManager) -> None:
+        self.engine = engine
+        self.budgets = budgets
+
+    def analyse(self, board: chess.Board, limit: Limit, **kwargs: Any) -> Union[InfoDict, List[InfoDict]]:
+        self.budgets.check(limit)
+        start = time.monotonic()
+        info = self.engine.analyse(board, limit, **kwargs)
+        self.budgets.charge(info_nodes(info), time.monotonic() - start)
+        return info
+
+    def play(self, board: chess.Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        self.budgets.check(limit)
+        kwargs.setdefault("info", chess.engine.INFO_BASIC)
+        start = time.monotonic()
+        result = self.engine.play(board, limit, **kwargs)
+        self.budgets.charge(info_nodes(result.info), time.monotonic() - start)
+        return result
+
+    def close(self) -> None:
+        self.engine.close()
@@ -0,0 +1,250 @@
+"""
+Random access to the games of a PGN dump by lichess game id.
+
+The index of FILE.pgn[.zst] is written next to it as FILE.pgn[.zst].idx:
+MAGIC, then one record per game sorted by game id:
+game id (8 bytes), compressed offset of the zstd frame holding the start of the game (u64),
+offset of the game's [Event line in the decompressed frame (u64).
+Plain PGN files are a single frame starting at 0.
+"""
+import argparse
+import heapq
+import io
+import logging
+import mmap
+import os
+import re
+import struct
+import numpy as np
+import zstandard
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+from gamecache import SITE_PREFIX
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+MAGIC = b"LPGI\x01\x00\x00\x00"
+RECORD = struct.Struct("<8sQQ")
+TABLE = np.dtype([("id", "S8"), ("frame", "<u8"), ("offset", "<u8")])
+CHUNK = 1 << 20
+# records sorted in memory at once, about 100MB: larger dumps are sorted by runs merged from disk
+RUN = 1 << 22
+TAG_REGEX = re.compile(rb'^\[(Event|Site) "([^"\n]*)"', re.MULTILINE)
+
+def index_path(file: str) -> str:
+    return file + ".idx"
+
+def decompressed_chunks(raw: BinaryIO) -> Iterator[Tuple[int, bytes]]:
+    """
+    yields (compressed offset of the frame, next decompressed bytes of the frame), frame after frame
+    """
+    dctx = zstandard.ZstdDecompressor()
+    frame = 0
+    data = raw.read(CHUNK)
+    while data:
+        obj = dctx.decompressobj()
+        consumed = 0
+        while True:
+            out = obj.decompress(data)
+            if out:
+                yield frame, out
+            if obj.eof:
+                rest = obj.unused_data
+                consumed += len(data) - len(rest)
+                data = rest or raw.read(CHUNK)
+                break
+            consumed += len(data)
+            data = raw.read(CHUNK)
+            if not data:
+                raise ValueError(f"truncated zstd frame at {frame}")
+        frame += consumed
+
+def frame_chunks(file: str) -> Iterator[Tuple[int, bytes]]:
+    with open(file, "rb") as raw:
+        if file.endswith(".zst"):
+            yield from decompressed_chunks(raw)
+        else:
+            for chunk in iter(lambda: raw.read(CHUNK), b""):
+                yield 0, chunk
+
+def scan_games(file: str) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    yields (game id, frame, offset in frame) for every game of the dump, in file order
+    """
+    # complete lines not scanned yet, and where they start
+    pending = b""
+    pending_frame, pending_offset = 0, 0
+    # where the next chunk starts
+    frame, offset = -1, 0
+    start = (0, 0)
+    for chunk_frame, chunk in frame_chunks(file):
+        if chunk_frame != frame:
+            frame, offset = chunk_frame, 0
+        if not pending:
+            pending_frame, pending_offset = frame, offset
+        carried = len(pending)
+        pending += chunk
+        offset += len(chunk)
+        end = pending.rfind(b"\n") + 1
+        for match in TAG_REGEX.finditer(pending, 0, end):
+            # a line carried over from the previous frame starts in it
+            at = (pending_frame, pending_offset + match.start()) if match.start() < carried else (frame, offset - len(pending) + match.start())
+            if match.group(1) == b"Event":
+                start = at
+            else:
+                yield match.group(2)[len(SITE_PREFIX):], start[0], start[1]
+        if end:
+            pending_frame, pending_offset = (pending_frame, pending_offset + end) if end < carried else (frame, offset - len(pending) + end)
+            pending = pending[end:]
+
+def write_run(out: BinaryIO, records: bytearray) -> int:
+    table = np.frombuffer(records, dtype = TABLE)
+    out.write(table[np.argsort(table["id"], kind = "stable")].tobytes())
+    return len(table)
+
+def run_records(run: np.ndarray) -> Iterator[Tuple[bytes, int, int]]:
+    for start in range(0, len(run), CHUNK // TABLE.itemsize):
+        yield from run[start:start + CHUNK // TABLE.itemsize].tolist()
+
+def build_index(file: str, output: str) -> int:
+    """
+    Writes the records in sorted runs of RUN games to a temporary file next to `output`,
+    then merges the runs into the index, keeping memory bounded whatever the size of the dump.
+    """
+    runs_path = output + ".runs"
+    runs: List[Tuple[int, int]] = []
+    records = bytearray()
+    count = 0
+    try:
+        with open(runs_path, "wb") as out:
+            for game_id, frame, offset in scan_games(file):
+                records += RECORD.pack(game_id, frame, offset)
+                if len(records) >= RUN * RECORD.size:
+                    runs.append((count, write_run(out, records)))
+                    count += runs[-1][1]
+                    records = bytearray()
+            if records:
+                runs.append((count, write_run(out, records)))
+                count += runs[-1][1]
+        with open(output, "wb") as out:
+            out.write(MAGIC)
+            if count:
+                table = np.memmap(runs_path, dtype = TABLE, mode = "r")
+                # records compare by id, then by position in the dump like the stable sort of a single run
+                block: List[Tuple[bytes, int, int]] = []
+                for record in heapq.merge(*(run_records(table[start:start + length]) for start, length in runs)):
+                    block.append(record)
+                    if len(block) * RECORD.size >= CHUNK:
+                        out.write(np.array(block, dtype = TABLE).tobytes())
+                        block.clear()
+                out.write(np.array(block, dtype = TABLE).tobytes())
+                del table
+    finally:
+        os.remove(runs_path)
+    return count
+
+
+class DumpIndex:
+    """
+    Memory-mapped index of a PGN dump, reads single games by id without scanning the dump
+    """
+
+    def __init__(self, file: str, index: Optional[str] = None) -> None:
+        self.file = file
+        with open(index or index_path(file), "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{index or index_path(file)} is not a dump index")
+        self.table = np.frombuffer(self.mmap, dtype = TABLE, offset = len(MAGIC))
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def find(self, game_id: str) -> Optional[Tuple[int, int]]:
+        key = game_id.encode()
+        i = int(np.searchsorted(self.table["id"], key))
+        if i < len(self.table) and self.table[i]["id"] == key:
+            return int(self.table[i]["frame"]), int(self.table[i]["offset"])
+        return None
+
+    def lines(self, game_id: str) -> Optional[List[str]]:
+        """
+        the PGN lines of one game, from its [Event line to the next game
+        """
+        return next(self.games([game_id]))[1]
+
+    def games(self, game_ids: List[str]) -> Iterator[Tuple[str, Optional[List[str]]]]:
+        """
+        (game id, PGN lines like `lines`) of the given games, the missing ones first with None, then in dump order.
+        The dump is read once forward: a frame is only decompressed from its start for the first game found in it.
+        """
+        found: List[Tuple[Tuple[int, int], str]] = []
+        for game_id in game_ids:
+            at = self.find(game_id)
+            if at is None:
+                yield game_id, None
+            else:
+                found.append((at, game_id))
+        with open(self.file, "rb") as raw:
+            reader: BinaryIO = raw
+            frame, position = -1, 0
+            # the [Event line ending the previous game, and where it starts
+            pending: Optional[Tuple[int, bytes]] = None
+            last: Optional[Tuple[Tuple[int, int], List[str]]] = None
+            for at, game_id in sorted(found):
+                if last and last[0] == at:
+                    # asked twice
+                    yield game_id, last[1]
+                    continue
+                at_frame, offset = at
+                if at_frame != frame or offset < (pending[0] if pending else position):
+                    raw.seek(at_frame)
+                    if self.file.endswith(".zst"):
+                        reader = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames = True, closefd = False), CHUNK)
+                    frame, position, pending = at_frame, 0, None
+                lines: List[bytes] = []
+                if pending and pending[0] == offset:
+                    lines.append(pending[1])
+                elif reader is raw:
+                    raw.seek(offset)
+                    position = offset
+                else:
+                    while position < offset:
+                        skipped = len(reader.read(min(offset - position, CHUNK)))
+                        if not skipped:
+                            break
+                        position += skipped
+                pending = None
+                for line in iter(reader.readline, b""):
+                    position += len(line)
+                    if lines and line.startswith(b"[Event "):
+                        pending = (position - len(line), line)
+                        break
+                    lines.append(line)
+                last = (at, [line.decode("utf-8") for line in lines])
+                yield game_id, last[1]
+
+    def close(self) -> None:
+        del self.table
+        self.mmap.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='dumpindex.py',
+        description='indexes the games of a pgn dump by id, for generator.py --games')
+    parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
+    parser.add_argument("--output", "-o", help="index file to write, default FILE.pgn.idx", metavar="FILE.idx")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    logger.setLevel(logging.INFO)
+    output = args.output or index_path(args.file)
+    indexed = build_index(args.file, output)
+    logger.info(f"Indexed {indexed} games of {args.file} into {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compact cache of the eval-annotated games of a PGN dump, so that new generator
+versions don't have to decompress and parse the whole dump again.
+With --all-games, games without evals are cached too, for annotate.py to fill in their evals.
+
+File: MAGIC, then one record per game:
+game id (8 bytes), header tier (u8), move count n (u16), n u16 moves, n i16 evals
+"""
+import argparse
+import logging
+import mmap
+import struct
+from array import array
+from typing import BinaryIO, Iterator, Tuple
+from mainline import Mainline
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+MAGIC = b"LPGC\x01\x00\x00\x00"
+RECORD = struct.Struct("<8sBH")
+SITE_PREFIX = "https://lichess.org/"
+
+def is_game_cache(file: str) -> bool:
+    return file.endswith(".pgc")
+
+def write_record(out: BinaryIO, tier: int, mainline: Mainline) -> None:
+    out.write(RECORD.pack(mainline.game_id().encode(), tier, len(mainline.moves)))
+    out.write(mainline.moves.tobytes())
+    out.write(mainline.evals.tobytes())
+
+
+class GameCache:
+    """
+    Iterates over the games of one part of a cache file, as ((game number, tier), mainline) pairs,
+    like a parsed DumpReader
+    """
+
+    def __init__(self, file: str, part: int = 1, parts: int = 1, skip: int = 0) -> None:
+        self.file = file
+        self.part = part
+        self.parts = parts
+        self.skip = skip
+        self.games = 0
+
+    def __iter__(self) -> Iterator[Tuple[Tuple[int, int], Mainline]]:
+        with open(self.file, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.file} is not a game cache")
+            offset = len(MAGIC)
+            while offset < len(data):
+                game_id, tier, nb_moves = RECORD.unpack_from(data, offset)
+                offset += RECORD.size
+                end = offset + 4 * nb_moves
+                self.games += 1
+                if self.games >= self.skip and self.games % self.parts == self.part - 1:
+                    moves = array("H")
+                    moves.frombytes(data[offset:offset + 2 * nb_moves])
+                    evals = array("h")
+                    evals.frombytes(data[offset + 2 * nb_moves:end])
+                    yield (self.games, tier), Mainline({"Site": SITE_PREFIX + game_id.rstrip(b"\0").decode()}, moves, evals)
+                offset = end
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='gamecache.py',
+        description='extracts the games with evals of a pgn dump into a compact cache the generator can read')
+    parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
+    parser.add_argument("--output", "-o", help="cache file to write", required=True, metavar="FILE.pgc")
+    parser.add_argument("--parsers", help="count of PGN parsing processes", default="0")
+    parser.add_argument("--all-games", help="also cache the games without evals, to be annotated by annotate.py", action="store_true")
+    return parser.parse_args()
+
+
+def main() -> None:
+    from generator import DumpReader
+    from parsing import ParserPool
+    args = parse_args()
+    logger.setLevel(logging.INFO)
+    reader = DumpReader(args.file, 1, 1, evals_only = not args.all_games)
+    parser = ParserPool(int(args.parsers))
+    cached = 0
+    with open(args.output, "wb") as out:
+        out.write(MAGIC)
+        for (_, tier), mainline in parser.parse(reader):
+            if mainline:
+                write_record(out, tier, mainline)
+                cached += 1
+    parser.close()
+    logger.info(f"Cached {cached} of {reader.games} games from {args.file} into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
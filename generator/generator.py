@@ -1,5 +1,6 @@
 import logging
 import argparse
+import json
 import chess
 import chess.pgn
 import chess.engine
@@ -7,29 +8,74 @@ import copy
 import sys
 import util
 import zstandard
+from dataclasses import dataclass
 from model import Puzzle, NextMovePair
 from io import StringIO
+from itertools import dropwhile
 from chess import Move, Color
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess.pgn import Game, ChildNode
-from typing import List, Optional, Union, Set
-from util import get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances, count_mates
+from chess.polyglot import zobrist_hash
+from typing import Iterator, List, Literal, Optional, Union, Set, Tuple
+from mainline import Mainline, decode_eval
+from parsing import ParserPool
+from gamecache import GameCache, is_game_cache
+from dumpindex import DumpIndex
+from memory import MemoryReport
+from profiler import Profiler
+from util import decode_move, get_next_move_pair, pair_from_info, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances, count_mates
 from server import Server
-
-version = 48
+from supervisor import SupervisedEngine, Engine
+from budget import Allowance, BudgetManager, BudgetedEngine, BudgetExceeded
+from tablebase import Tablebase
+from rejections import Rejections
+from limits import BASE_LIMITS, LimitPolicy, make_policy
+from verdicts import Verdict, VerdictCache
+from probepool import Cancelled, CancellableEngine, ProbePool
+from speculation import Speculator
+from yieldmodel import YieldModel
+
+version = 49
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
 
-pair_limit = chess.engine.Limit(depth = 50, time = 30, nodes = 30_000_000)
-mate_defense_limit = chess.engine.Limit(depth = 15, time = 10, nodes = 10_000_000)
+pair_limit = BASE_LIMITS["pair"]
+mate_defense_limit = BASE_LIMITS["defense"]
 
 mate_soon = Mate(15)
 
+Probe = Literal["mate", "advantage"]
+
+@dataclass
+class Candidate:
+    ply: int
+    node: ChildNode
+    kind: Probe
+    prev_score: Score
+    score: Score
+
 class Generator:
-    def __init__(self, engine: SimpleEngine, server: Server):
-        self.engine = engine
+    def __init__(self, engine: Engine, server: Server, budgets: Optional[BudgetManager] = None, tablebase: Optional[Tablebase] = None, rejections: Optional[Rejections] = None, limits: Optional[LimitPolicy] = None, verdicts: Optional[VerdictCache] = None, speculator: Optional[SupervisedEngine] = None):
+        # unlimited budgets still count the engine cost of each rejection
+        self.budgets = budgets or BudgetManager(Allowance(), Allowance())
+        self.engine = BudgetedEngine(engine, self.budgets)
         self.server = server
+        self.tablebase = tablebase
+        self.rejections = rejections or Rejections(logger)
+        self.limits = limits or LimitPolicy.fixed()
+        self.verdicts = verdicts
+        # probes candidates concurrently when set
+        self.probes: Optional[ProbePool] = None
+        self.speculator = Speculator(speculator, self.budgets) if speculator else None
+        # games scoring below min_yield_score are skipped
+        self.yield_model: Optional[YieldModel] = None
+        self.min_yield_score = 0.0
+        # why the last probe failed
+        self.rejection = ""
+        # tier of the probed game and score of the line being searched, to pick search limits
+        self.tier = 0
+        self.expected: Optional[Score] = None
 
     def is_valid_mate_in_one(self, pair: NextMovePair) -> bool:
         if pair.best.score != Mate(1):
@@ -58,16 +104,58 @@ class Generator:
         )
 
     def get_next_pair(self, node: ChildNode, winner: Color) -> Optional[NextMovePair]:
-        pair = get_next_move_pair(self.engine, node, winner, pair_limit)
-        if node.board().turn == winner and not self.is_valid_attack(pair):
+        """
+        the defending side only needs its best move, its pair has no second move
+        """
+        board = node.board()
+        attacking = board.turn == winner
+        pair = (
+            self.tablebase_pair(node, winner) or
+            self.speculated_pair(node, board, winner) or
+            get_next_move_pair(
+                self.engine, node, winner,
+                self.limits.limit("pair" if attacking else "reply", board, self.tier, self.expected),
+                multipv = 2 if attacking else 1
+            )
+        )
+        self.expected = pair.best.score
+        if attacking and not self.is_valid_attack(pair):
             logger.debug("No valid attack {}".format(pair))
+            self.rejection = "no valid attack"
             return None
         return pair
 
     def get_next_move(self, node: ChildNode, limit: chess.engine.Limit) -> Optional[Move]:
-        result = self.engine.play(node.board(), limit = limit)
+        board = node.board()
+        if self.tablebase and self.tablebase.covers(board):
+            move = self.tablebase.best_move(board)
+            if move:
+                return move
+        result = self.engine.play(board, limit = limit)
         return result.move if result else None
 
+    def speculated_pair(self, node: ChildNode, board: chess.Board, winner: Color) -> Optional[NextMovePair]:
+        info = self.speculator.take(board) if self.speculator else None
+        return pair_from_info(node, winner, info) if info else None
+
+    def speculate(self, board: chess.Board, pair: NextMovePair) -> None:
+        """
+        searches the position after the best move and its expected reply on the second engine,
+        while the main one checks the reply
+        """
+        if not self.speculator or not pair.ponder:
+            return
+        predicted = board.copy()
+        predicted.push(pair.best.move)
+        predicted.push(pair.ponder)
+        if not predicted.is_game_over():
+            self.speculator.speculate(predicted, self.limits.limit("pair", predicted, self.tier, pair.best.score))
+
+    def tablebase_pair(self, node: ChildNode, winner: Color) -> Optional[NextMovePair]:
+        if self.tablebase and self.tablebase.covers(node.board()):
+            return self.tablebase.next_move_pair(node, winner)
+        return None
+
     def cook_mate(self, node: ChildNode, winner: Color) -> Optional[List[Move]]:
 
         board = node.board()
@@ -81,11 +169,13 @@ class Generator:
                 return None
             if pair.best.score < mate_soon:
                 logger.debug("Best move is not a mate, we're probably not searching deep enough")
+                self.rejection = "mate not found"
                 return None
             move = pair.best.move
         else:
-            next = self.get_next_move(node, mate_defense_limit)
+            next = self.get_next_move(node, self.limits.limit("defense", board, self.tier, self.expected))
             if not next:
+                self.rejection = "no defense"
                 return None
             move = next
 
@@ -103,6 +193,7 @@ class Generator:
 
         if board.is_repetition(2):
             logger.debug("Found repetition, canceling")
+            self.rejection = "repetition in solution"
             return None
 
         pair = self.get_next_pair(node, winner)
@@ -110,7 +201,10 @@ class Generator:
             return []
         if pair.best.score < Cp(200):
             logger.debug("Not winning enough, aborting")
+            self.rejection = "not winning enough"
             return None
+        if board.turn == winner:
+            self.speculate(board, pair)
 
         follow_up = self.cook_advantage(node.add_main_variation(pair.best.move), winner)
 
@@ -120,92 +214,220 @@ class Generator:
         return [pair] + follow_up
 
 
-    def analyze_game(self, game: Game, tier: int) -> Optional[Puzzle]:
+    def analyze_game(self, game: Union[Game, Mainline], tier: int) -> Optional[Puzzle]:
+
+        mainline = game if isinstance(game, Mainline) else Mainline.from_game(game)
+        site = mainline.headers.get("Site")
+
+        logger.debug(f'Analyzing tier {tier} {site}...')
+
+        self.budgets.start_game()
+        self.rejections.start_game()
+
+        if self.yield_model:
+            yield_score = self.yield_model.score(mainline, tier)
+            if yield_score < self.min_yield_score:
+                logger.debug("Skipping unlikely game, yield score {:.2f}".format(yield_score))
+                self.rejections.record("low yield score", tier)
+                return None
+
+        if self.probes:
+            puzzle = self.probes.first_puzzle(list(self.candidates(mainline, tier)), tier)
+            if puzzle is None:
+                logger.debug("Found nothing from {}".format(site))
+            return puzzle
+
+        for candidate in self.candidates(mainline, tier):
+            try:
+                result = self.probe_position(candidate.node, candidate.kind, candidate.prev_score, candidate.score, tier)
+            except BudgetExceeded as e:
+                self.budgets.abandon(mainline.game_id(), candidate.ply, e)
+                if e.budget.scope == "game":
+                    return None
+                continue
+
+            if isinstance(result, Puzzle):
+                return result
+
+        logger.debug("Found nothing from {}".format(site))
+
+        return None
 
-        logger.debug(f'Analyzing tier {tier} {game.headers.get("Site")}...')
+
+    def candidates(self, mainline: Mainline, tier: int) -> Iterator[Candidate]:
+        """
+        positions of the game that pass the cheap checks, in order.
+        Probing a candidate doesn't change the next ones, a rejected probe returns the eval of the game.
+        """
 
         prev_score: Score = Cp(20)
-        seen_epds: Set[str] = set()
-        board = game.board()
+        seen_keys: Set[int] = set()
+        board = mainline.board()
+        nodes = mainline.nodes()
         skip_until_irreversible = False
 
-        for node in game.mainline():
+        for ply, (code, value) in enumerate(zip(mainline.moves, mainline.evals), 1):
+            move = decode_move(code)
             if skip_until_irreversible:
-                if board.is_irreversible(node.move):
+                if board.is_irreversible(move):
                     skip_until_irreversible = False
-                    seen_epds.clear()
+                    seen_keys.clear()
                 else:
-                    board.push(node.move)
+                    board.push(move)
                     continue
 
-            current_eval = node.eval()
+            current_eval = decode_eval(value)
 
             if not current_eval:
-                logger.debug("Skipping game without eval on ply {}".format(node.ply()))
-                return None
-
-            board.push(node.move)
-            epd = board.epd()
-            if epd in seen_epds:
+                logger.debug("Skipping game without eval on ply {}".format(ply))
+                self.rejections.record("missing eval", tier)
+                return
+
+            board.push(move)
+            key = zobrist_hash(board)
+            if key in seen_keys:
+                self.rejections.record("repetition", tier)
                 skip_until_irreversible = True
                 continue
-            seen_epds.add(epd)
+            seen_keys.add(key)
 
             if board.castling_rights != maximum_castling_rights(board):
+                self.rejections.record("castling rights", tier)
                 continue
 
-            result = self.analyze_position(node, prev_score, current_eval, tier)
+            score = current_eval.pov(board.turn)
+            kind = self.screen_position(board, prev_score, score, tier)
+            if kind:
+                # game nodes are only built for positions worth probing
+                yield Candidate(ply, nodes.at(ply), kind, prev_score, score)
 
-            if isinstance(result, Puzzle):
-                return result
+            prev_score = -score
 
-            prev_score = -result
 
-        logger.debug("Found nothing from {}".format(game.headers.get("Site")))
+    def close(self) -> None:
+        if self.probes:
+            # this generator is one of the probers
+            self.probes.close()
+        else:
+            self.close_engines()
 
-        return None
+    def close_engines(self) -> None:
+        if self.speculator:
+            self.speculator.close()
+        self.engine.close()
 
+    def start_candidate(self) -> None:
+        self.budgets.start_candidate()
 
     def analyze_position(self, node: ChildNode, prev_score: Score, current_eval: PovScore, tier: int) -> Union[Puzzle, Score]:
 
         board = node.board()
+        score = current_eval.pov(board.turn)
+        kind = self.screen_position(board, prev_score, score, tier)
+        if kind is None:
+            return score
+        return self.probe_position(node, kind, prev_score, score, tier)
+
+
+    # cheap checks on the board alone, returns which probe the position deserves if any
+    def screen_position(self, board: chess.Board, prev_score: Score, score: Score, tier: int) -> Optional[Probe]:
+
         winner = board.turn
-        score = current_eval.pov(winner)
 
         if board.legal_moves.count() < 2:
-            return score
+            self.rejections.record("forced move", tier)
+            return None
 
-        game_url = node.game().headers.get("Site")
+        ply = board.ply()
 
-        logger.debug("{} {} to {}".format(node.ply(), node.move.uci() if node.move else None, score))
+        logger.debug("{} {} to {}".format(ply, board.peek().uci() if board.move_stack else None, score))
 
         if prev_score > Cp(300) and score < mate_soon:
-            logger.debug("{} Too much of a winning position to start with {} -> {}".format(node.ply(), prev_score, score))
-            return score
+            logger.debug("{} Too much of a winning position to start with {} -> {}".format(ply, prev_score, score))
+            self.rejections.record("already winning", tier)
+            return None
         if is_up_in_material(board, winner):
-            logger.debug("{} already up in material {} {} {}".format(node.ply(), winner, material_count(board, winner), material_count(board, not winner)))
-            return score
+            logger.debug("{} already up in material {} {} {}".format(ply, winner, material_count(board, winner), material_count(board, not winner)))
+            self.rejections.record("up in material", tier)
+            return None
         elif score >= Mate(1) and tier < 3:
-            logger.debug("{} mate in one".format(node.ply()))
-            return score
+            logger.debug("{} mate in one".format(ply))
+            self.rejections.record("mate in one", tier)
+            return None
         elif score > mate_soon:
+            return "mate"
+        elif score >= Cp(200) and win_chances(score) > win_chances(prev_score) + 0.6:
+            if score < Cp(400) and material_diff(board, winner) > -1:
+                logger.debug("Not clearly winning and not from being down in material, aborting")
+                self.rejections.record("not clearly winning", tier)
+                return None
+            return "advantage"
+        else:
+            self.rejections.record("no swing", tier)
+            return None
+
+
+    def probe_position(self, node: ChildNode, kind: Probe, prev_score: Score, score: Score, tier: int) -> Union[Puzzle, Score]:
+
+        key = VerdictCache.key(node.board(), prev_score) if self.verdicts else None
+        if self.verdicts and key:
+            verdict = self.verdicts.get(key, tier)
+            if verdict:
+                logger.debug("Already probed: {}".format(verdict.reason))
+                self.rejections.record(f"cached {verdict.reason}", tier)
+                return score
+
+        self.tier = tier
+        self.expected = score
+        if self.speculator:
+            self.speculator.discard()
+        total = self.budgets.total
+        nodes, time = total.nodes, total.time
+        self.rejection = f"{kind} not found"
+        outcome = "error"
+        try:
+            result = self.solve_position(node, kind, prev_score, score, tier)
+            outcome = "puzzle" if isinstance(result, Puzzle) else self.rejection
+            return result
+        except BudgetExceeded:
+            outcome = "out of budget"
+            raise
+        except Cancelled:
+            outcome = "cancelled"
+            raise
+        finally:
+            self.rejections.record(outcome, tier, total.nodes - nodes, total.time - time)
+            if self.verdicts and key:
+                self.verdicts.record(key, Verdict(tier, outcome, total.nodes - nodes))
+
+
+    def solve_position(self, node: ChildNode, kind: Probe, prev_score: Score, score: Score, tier: int) -> Union[Puzzle, Score]:
+
+        winner = node.turn()
+        game_url = node.game().headers.get("Site")
+
+        if kind == "mate":
             logger.debug("Mate {}#{} Probing...".format(game_url, node.ply()))
             if self.server.is_seen_pos(node):
                 logger.debug("Skip duplicate position")
+                self.rejection = "duplicate position"
                 return score
+            self.start_candidate()
             mate_solution = self.cook_mate(copy.deepcopy(node), winner)
-            if mate_solution is None or (tier == 1 and len(mate_solution) == 3):
+            if mate_solution is None:
                 return score
-            return Puzzle(node, mate_solution, 999999999)
-        elif score >= Cp(200) and win_chances(score) > win_chances(prev_score) + 0.6:
-            if score < Cp(400) and material_diff(board, winner) > -1:
-                logger.debug("Not clearly winning and not from being down in material, aborting")
+            if tier == 1 and len(mate_solution) == 3:
+                self.rejection = "mate in two"
                 return score
+            return Puzzle(node, mate_solution, 999999999)
+        else:
             logger.debug("Advantage {}#{} {} -> {}. Probing...".format(game_url, node.ply(), prev_score, score))
             if self.server.is_seen_pos(node):
                 logger.debug("Skip duplicate position")
+                self.rejection = "duplicate position"
                 return score
             puzzle_node = copy.deepcopy(node)
+            self.start_candidate()
             solution : Optional[List[NextMovePair]] = self.cook_advantage(puzzle_node, winner)
             self.server.set_seen(node.game())
             if not solution:
@@ -216,37 +438,126 @@ class Generator:
                 solution = solution[:-1]
             if not solution or len(solution) == 1 :
                 logger.debug("Discard one-mover")
+                self.rejection = "one-mover"
                 return score
             if tier < 3 and len(solution) == 3:
                 logger.debug("Discard two-mover")
+                self.rejection = "two-mover"
                 return score
             cp = solution[len(solution) - 1].best.score.score()
             return Puzzle(node, [p.best.move for p in solution], 999999998 if cp is None else cp)
-        else:
-            return score
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         prog='generator.py',
         description='takes a pgn file and produces chess puzzles')
-    parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--file", "-f", help="input PGN file, or game cache written by gamecache.py", metavar="FILE.pgn")
+    source.add_argument("--input-glob", help="process every matching PGN dump, spreading files and parts across workers", metavar="'DIR/*.pgn.zst'")
     parser.add_argument("--engine", "-e", help="analysis engine", default="./stockfish")
     parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--hash", help="engine hash table size in MB")
+    parser.add_argument("--config", help="engine layout written by tune.py, overrides --threads, --hash and --workers", metavar="LAYOUT.json")
+    parser.add_argument("--games", help="with --file, only mine these comma separated game ids, found through the index written by dumpindex.py", metavar="ID1,ID2")
+    parser.add_argument("--probers", help="engines probing the candidates of a game concurrently, 1 to probe them one after another", default="1")
+    parser.add_argument("--speculate", help="run a second engine per prober, analysing the position the principal variation predicts in advantage lines", action="store_true")
+    parser.add_argument("--yield-model", help="model trained by yieldmodel.py, predicting which games give puzzles", metavar="YIELD.npz")
+    parser.add_argument("--min-yield-score", help="with --yield-model, skip the games scoring below this, from 0 to 1", default="0.3")
+    parser.add_argument("--syzygy", help="directory of Syzygy tablebases, probed instead of the engine in small endgames")
     parser.add_argument("--url", "-u", help="URL where to post puzzles", default="http://localhost:8000")
     parser.add_argument("--token", help="Server secret token", default="changeme")
     parser.add_argument("--skip", help="How many games to skip from the source", default="0")
     parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
     parser.add_argument("--parts", help="how many parts", default="8")
     parser.add_argument("--part", help="which one of the parts", default="0")
-
-    return parser.parse_args()
-
-
-def make_engine(executable: str, threads: int) -> SimpleEngine:
-    engine = SimpleEngine.popen_uci(executable)
-    engine.configure({'Threads': threads})
-    return engine
+    parser.add_argument("--game-time", help="engine seconds allowed per game before abandoning it")
+    parser.add_argument("--game-nodes", help="engine nodes allowed per game before abandoning it")
+    parser.add_argument("--candidate-time", help="engine seconds allowed per probed position before abandoning it")
+    parser.add_argument("--candidate-nodes", help="engine nodes allowed per probed position before abandoning it")
+    parser.add_argument("--abandoned", help="file where games abandoned for lack of budget are recorded", default="abandoned.tsv")
+    parser.add_argument("--parsers", help="count of PGN parsing processes, 0 to parse in the engine driving process", default="0")
+    parser.add_argument("--parse-queue", help="how many parsed batches may wait for the engine, default twice --parsers", default="0")
+    parser.add_argument("--limits", help="engine search limits: fixed, adaptive to the position with uncalibrated scales, or calibrated by limits.py", default="fixed", metavar="fixed|adaptive|LIMITS.json")
+    parser.add_argument("--verdicts", help="file of the positions already probed for nothing by this version with the same engine, limits, budgets, tablebases and speculation, skipped next time, empty to disable", default="verdicts.tsv")
+    parser.add_argument("--rejection-report", help="log why positions were rejected and their engine cost every N games, 0 for only at exit", default="1000")
+    parser.add_argument("--memory-report", help="log a tracemalloc memory report every N games, 0 to disable", default="0")
+    parser.add_argument("--profile-control", help="sample stacks while this file exists, in addition to SIGUSR1 toggling", metavar="FILE")
+    parser.add_argument("--workers", help="with --input-glob, how many engine processes to run", default="1")
+    parser.add_argument("--ledger", help="with --input-glob, file recording completed file parts", default="generator-ledger.tsv")
+
+    args = parser.parse_args()
+    if args.games and (args.input_glob or is_game_cache(args.file)):
+        parser.error("--games needs a PGN dump --file")
+    if args.input_glob and int(args.skip):
+        parser.error("--skip needs a single --file, --input-glob resumes from the --ledger")
+    return args
+
+
+def make_engine(executable: str, threads: int, hash: Optional[int] = None) -> SupervisedEngine:
+    options = {'Threads': threads}
+    if hash:
+        options['Hash'] = hash
+    return SupervisedEngine(executable, options, lean = True)
+
+
+def load_layout(args: argparse.Namespace) -> None:
+    """
+    Applies an engine layout written by tune.py: engines (batch workers), threads and hash
+    """
+    with open(args.config) as f:
+        layout = json.load(f)
+    args.workers = str(layout["engines"])
+    args.threads = str(layout["threads"])
+    args.hash = str(layout["hash"]) if layout.get("hash") else None
+
+
+def make_generator(args: argparse.Namespace, server: Server) -> Generator:
+    probers = int(args.probers)
+    def engine(supervised: Optional[SupervisedEngine] = None) -> Engine:
+        supervised = supervised or make_engine(args.engine, int(args.threads), int(args.hash) if args.hash else None)
+        return CancellableEngine(supervised) if probers > 1 else supervised
+    def tablebase() -> Optional[Tablebase]:
+        return Tablebase(args.syzygy) if args.syzygy else None
+    def speculator() -> Optional[SupervisedEngine]:
+        return make_engine(args.engine, int(args.threads), int(args.hash) if args.hash else None) if args.speculate else None
+    rejections = Rejections(logger, int(args.rejection_report))
+    limits = make_policy(args.limits)
+    first = make_engine(args.engine, int(args.threads), int(args.hash) if args.hash else None)
+    verdicts = VerdictCache(args.verdicts, version, verdict_context(args, first.name(), limits)) if args.verdicts else None
+    generator = Generator(engine(first), server, make_budgets(args), tablebase(), rejections, limits, verdicts, speculator())
+    if args.yield_model:
+        generator.yield_model = YieldModel.load(args.yield_model)
+        generator.min_yield_score = float(args.min_yield_score)
+    if probers > 1:
+        generator.probes = ProbePool([generator] + [
+            Generator(engine(), server, make_budgets(args), tablebase(), rejections, limits, verdicts, speculator())
+            for _ in range(probers - 1)
+        ])
+    return generator
+
+
+def verdict_context(args: argparse.Namespace, engine_name: str, limits: LimitPolicy) -> str:
+    """
+    what the verdicts of a run depend on besides the position: engine, limits, budgets, tablebases and speculation
+    """
+    context = [engine_name, limits.signature()]
+    allowances = [args.game_time, args.game_nodes, args.candidate_time, args.candidate_nodes]
+    if any(allowances):
+        context.append("budgets=" + ",".join(allowance or "-" for allowance in allowances))
+    if args.syzygy:
+        context.append("syzygy")
+    if args.speculate:
+        context.append("speculate")
+    return " ".join(context)
+
+
+def make_budgets(args: argparse.Namespace) -> Optional[BudgetManager]:
+    game = Allowance(float(args.game_time) if args.game_time else None, int(args.game_nodes) if args.game_nodes else None)
+    candidate = Allowance(float(args.candidate_time) if args.candidate_time else None, int(args.candidate_nodes) if args.candidate_nodes else None)
+    if not game.is_limited() and not candidate.is_limited():
+        return None
+    return BudgetManager(game, candidate, args.abandoned)
 
 
 def open_file(file: str):
@@ -254,6 +565,139 @@ def open_file(file: str):
         return zstandard.open(file, "rt")
     return open(file)
 
+class DumpReader:
+    """
+    Iterates over the games of one part of a PGN dump that are worth parsing,
+    as ((game number, tier), game text) pairs.
+    Games without evals are skipped, unless `evals_only` is off.
+    """
+
+    def __init__(self, file: str, part: int, parts: int, skip: int = 0, evals_only: bool = True) -> None:
+        self.file = file
+        self.part = part
+        self.parts = parts
+        self.skip = skip
+        self.evals_only = evals_only
+        self.games = 0
+
+    def lines(self) -> Iterator[str]:
+        with open_file(self.file) as pgn:
+            yield from pgn
+
+    def __iter__(self) -> Iterator[Tuple[Tuple[int, int], str]]:
+        site = "?"
+        has_master = False
+        tier = 0
+        skip_next = False
+        for line in self.lines():
+            if line.startswith("[Site "):
+                site = line
+                self.games = self.games + 1
+                has_master = False
+                tier = 4
+            elif self.games < self.skip:
+                continue
+            elif self.games % self.parts != self.part - 1:
+                continue
+            if tier == 0:
+                skip_next = True
+            elif line.startswith("[Variant ") and not line.startswith("[Variant \"Standard\"]"):
+                skip_next = True
+            elif (
+                    (line.startswith("[WhiteTitle ") or line.startswith("[BlackTitle ")) and
+                    "BOT" not in line
+                ):
+                has_master = True
+            else:
+                r_tier = util.rating_tier(line)
+                t_tier = util.time_control_tier(line)
+                if r_tier is not None:
+                    tier = min(tier, r_tier)
+                elif t_tier is not None:
+                    tier = min(tier, t_tier)
+                elif line.startswith("1. ") and skip_next:
+                    logger.debug("Skip {}".format(site))
+                    skip_next = False
+                elif "%eval" in line or (line.startswith("1. ") and not self.evals_only):
+                    tier = tier + 1 if has_master else tier
+                    yield (self.games, tier), "{}\n{}".format(site, line)
+
+
+class IndexedGames(DumpReader):
+    """
+    Reads only the given games of a PGN dump, in dump order, through the index written by dumpindex.py
+    """
+
+    def __init__(self, file: str, game_ids: List[str]) -> None:
+        super().__init__(file, 1, 1)
+        self.game_ids = game_ids
+
+    def lines(self) -> Iterator[str]:
+        index = DumpIndex(self.file)
+        try:
+            for game_id, lines in index.games(self.game_ids):
+                if lines is None:
+                    logger.warning(f"Game {game_id} is not in {self.file}")
+                    continue
+                # from [Site on, the [Event line would be read with the tier of the previous game
+                yield from dropwhile(lambda line: not line.startswith("[Site "), lines)
+        finally:
+            index.close()
+
+
+def adjusted_tier(tier: int, nb_moves: int) -> int:
+    """
+    short games are decisive early, and searched like a higher tier
+    """
+    tier = tier + 1 if nb_moves < 38 else tier
+    return tier + 1 if nb_moves < 21 else tier
+
+
+def process_file(generator: Generator, server: Server, file: str, part: int, parts: int, skip: int = 0, parser: Optional[ParserPool] = None, memory: Optional[MemoryReport] = None, game_ids: Optional[List[str]] = None) -> Tuple[int, int]:
+    """
+    Mines one part of a PGN dump, or only the given games of it, returns how many games were read and how many puzzles were posted
+    """
+    reader: Union[DumpReader, GameCache]
+    if is_game_cache(file):
+        reader = GameCache(file, part, parts, skip)
+        mainlines = iter(reader)
+    else:
+        parser = parser or ParserPool(0)
+        reader = IndexedGames(file, game_ids) if game_ids else DumpReader(file, part, parts, skip)
+        mainlines = parser.parse(reader)
+    puzzles = 0
+    try:
+        for (games, tier), mainline in mainlines:
+            if not mainline:
+                # unparsable, already logged by the parser
+                continue
+            if memory:
+                memory.tick({
+                    "parse batches in flight": parser.pending_batches if parser else 0,
+                    "seen positions": len(server.seen_positions) + len(server.old_seen_positions),
+                    "knps samples": len(util.nps),
+                })
+            tier = adjusted_tier(tier, len(mainline.moves))
+            game_id = mainline.game_id()
+            if server.is_seen(game_id):
+                logger.info(f'Game {game_id} was already seen before, skipping - {games}')
+                continue
+
+            # logger.info(f'https://lichess.org/{game_id} tier {tier}')
+            try:
+                puzzle = generator.analyze_game(mainline, tier)
+                if puzzle is not None:
+                    logger.info(f'v{version} {file} {part}/{parts} {util.avg_knps()} knps, tier {tier}, game {games}')
+                    server.post(game_id, puzzle)
+                    puzzles += 1
+            except Exception as e:
+                logger.error("Exception on {}: {}".format(game_id, e))
+    except KeyboardInterrupt:
+        print(f'v{version} {file} Game {reader.games}')
+        raise
+    return reader.games, puzzles
+
+
 def main() -> None:
     sys.setrecursionlimit(10000) # else node.deepcopy() sometimes fails?
     args = parse_args()
@@ -261,79 +705,41 @@ def main() -> None:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-    engine = make_engine(args.engine, args.threads)
+
+    # before the profiler thread and the engines
+    parser = ParserPool(int(args.parsers), in_flight = int(args.parse_queue)) if not args.input_glob else None
+
+    Profiler(control_file = args.profile_control).install()
+
+    if args.config:
+        load_layout(args)
+
+    if args.input_glob:
+        from batch import run_batch
+        run_batch(args, version)
+        return
+
     server = Server(logger, args.url, args.token, version)
-    generator = Generator(engine, server)
-    games = 0
-    site = "?"
-    has_master = False
-    tier = 0
+    generator = make_generator(args, server)
     skip = int(args.skip)
     logger.info("Skipping first {} games".format(skip))
 
     parts = int(args.parts)
     part = int(args.part)
+    game_ids = args.games.split(",") if args.games else None
     print(f'v{version} {args.file} {part}/{parts}')
 
+    memory = MemoryReport(logger, int(args.memory_report)) if int(args.memory_report) else None
     try:
-        with open_file(args.file) as pgn:
-            skip_next = False
-            for line in pgn:
-                if line.startswith("[Site "):
-                    site = line
-                    games = games + 1
-                    has_master = False
-                    tier = 4
-                elif games < skip:
-                    continue
-                elif games % parts != part - 1:
-                    continue
-                if tier == 0:
-                    skip_next = True
-                elif line.startswith("[Variant ") and not line.startswith("[Variant \"Standard\"]"):
-                    skip_next = True
-                elif (
-                        (line.startswith("[WhiteTitle ") or line.startswith("[BlackTitle ")) and
-                        "BOT" not in line
-                    ):
-                    has_master = True
-                else:
-                    r_tier = util.rating_tier(line)
-                    t_tier = util.time_control_tier(line)
-                    if r_tier is not None:
-                        tier = min(tier, r_tier)
-                    elif t_tier is not None:
-                        tier = min(tier, t_tier)
-                    elif line.startswith("1. ") and skip_next:
-                        logger.debug("Skip {}".format(site))
-                        skip_next = False
-                    elif "%eval" in line:
-                        tier = tier + 1 if has_master else tier
-                        game = chess.pgn.read_game(StringIO("{}\n{}".format(site, line)))
-                        assert(game)
-                        nb_moves = len(list(game.mainline_moves()))
-                        tier = tier + 1 if nb_moves < 38 else tier
-                        tier = tier + 1 if nb_moves < 21 else tier
-                        game_id = game.headers.get("Site", "?")[20:]
-                        if server.is_seen(game_id):
-                            to_skip = 1
-                            logger.info(f'Game {game_id} was already seen before, skipping {to_skip} - {games}')
-                            skip = games + to_skip
-                            continue
-
-                        # logger.info(f'https://lichess.org/{game_id} tier {tier}')
-                        try:
-                            puzzle = generator.analyze_game(game, tier)
-                            if puzzle is not None:
-                                logger.info(f'v{version} {args.file} {part}/{parts} {util.avg_knps()} knps, tier {tier}, game {games}')
-                                server.post(game_id, puzzle)
-                        except Exception as e:
-                            logger.error("Exception on {}: {}".format(game_id, e))
+        process_file(generator, server, args.file, part, parts, skip, parser, memory, game_ids)
     except KeyboardInterrupt:
-        print(f'v{version} {args.file} Game {games}')
+        generator.rejections.report()
         sys.exit(1)
 
-    engine.close()
+    generator.rejections.report()
+    if parser:
+        parser.close()
+    generator.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,44 @@
+import re
+import chess
+import chess.engine
+from chess.engine import SimpleEngine, UciProtocol, Limit, InfoDict, Info, INFO_ALL, INFO_NONE, ConfigMapping
+from typing import Dict, Iterable, List, Optional, Union
+
+MULTIPV_REGEX = re.compile(r" multipv (\d+)")
+
+class LeanUciProtocol(UciProtocol):
+    """
+    UCI protocol whose `analyse` keeps the raw info lines of the engine and only parses the last one
+    of each multipv slot once the search is over. A deep multipv search sends thousands of info lines,
+    the default protocol parses each of them into scores and PV moves just to keep the last ones.
+    Unlike the default protocol, keys of earlier lines the last one doesn't repeat are not kept,
+    like an info string or the lowerbound of an earlier depth.
+    `analysis` is left as is, for callers following the search.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.recording = False
+        self.last_info: Dict[int, str] = {}
+
+    def line_received(self, line: str) -> None:
+        if self.recording and line.startswith("info ") and " score " in line:
+            match = MULTIPV_REGEX.search(line)
+            self.last_info[int(match.group(1)) if match else 1] = line[5:]
+
+    async def analyse(self, board: chess.Board, limit: Limit, *, multipv: Optional[int] = None, game: object = None, info: Info = INFO_ALL, root_moves: Optional[Iterable[chess.Move]] = None, options: ConfigMapping = {}) -> Union[List[InfoDict], InfoDict]: # type: ignore
+        self.last_info = {}
+        self.recording = True
+        try:
+            await super().analyse(board, limit, multipv = multipv, game = game, info = INFO_NONE, root_moves = root_moves, options = options)
+        finally:
+            self.recording = False
+        slots = [
+            chess.engine._parse_uci_info(self.last_info[slot], board, info) if slot in self.last_info else {}
+            for slot in range(1, max(self.last_info, default = 1) + 1)
+        ]
+        return slots[0] if multipv is None else slots
+
+
+def popen_lean_uci(executable: Union[str, List[str]]) -> SimpleEngine:
+    return SimpleEngine.popen(LeanUciProtocol, executable)
@@ -0,0 +1,196 @@
+"""
+Engine search limits picked from cheap features of the position instead of one limit for all:
+legal move count, material, check, distance to a known mate and game tier.
+
+The node and time limits of the base limits are scaled per complexity class and per tier.
+Attacking moves ("pair"), defending replies in advantage lines ("reply") and mate defenses ("defense")
+each have their own base limit, which a limits file can override under "base".
+The class scales can be calibrated on a sample of games: every screened candidate is searched
+to twice the base limit, recording when the best move stopped changing, then each class gets
+the nodes that settled 90% of its searches, with a safety margin.
+
+    python3 limits.py -f sample.pgn --sample 200 -o limits.json
+    python3 generator.py -f dump.pgn.zst --limits limits.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import chess
+import chess.engine
+from dataclasses import dataclass, field
+from chess import Board
+from chess.engine import Limit, Score
+from typing import Dict, List, Literal, Optional
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+Kind = Literal["pair", "reply", "defense"]
+
+BASE_LIMITS: Dict[str, Limit] = {
+    "pair": Limit(depth = 50, time = 30, nodes = 30_000_000),
+    # single PV, only the best defense is played: half the nodes reach about the same depth
+    "reply": Limit(depth = 50, time = 15, nodes = 15_000_000),
+    "defense": Limit(depth = 15, time = 10, nodes = 10_000_000),
+}
+
+CLASSES = ["forced", "short mate", "endgame", "normal", "complex"]
+
+# uncalibrated guesses, the time saved on simple positions goes to complex ones
+DEFAULT_SCALES = {"forced": 0.25, "short mate": 0.25, "endgame": 0.5, "normal": 1.0, "complex": 1.5}
+
+# weaker games are worth less engine time
+DEFAULT_TIER_SCALES = {0: 0.5, 1: 0.75}
+
+MAX_SCALE = 2.0
+
+def complexity(board: Board, expected: Optional[Score] = None) -> str:
+    """
+    `expected` is the score of the line so far, for the side to move or its opponent
+    """
+    moves = board.legal_moves.count()
+    if moves <= 3 or (board.is_check() and moves <= 6):
+        return "forced"
+    mate = expected.mate() if expected is not None else None
+    if mate is not None and abs(mate) <= 3:
+        return "short mate"
+    if chess.popcount(board.occupied) <= 8:
+        return "endgame"
+    if moves >= 35:
+        return "complex"
+    return "normal"
+
+
+@dataclass
+class LimitPolicy:
+    scales: Dict[str, float] = field(default_factory = lambda: dict(DEFAULT_SCALES))
+    tier_scales: Dict[int, float] = field(default_factory = lambda: dict(DEFAULT_TIER_SCALES))
+    bases: Dict[str, Limit] = field(default_factory = lambda: dict(BASE_LIMITS))
+
+    def limit(self, kind: Kind, board: Board, tier: int, expected: Optional[Score] = None) -> Limit:
+        base = self.bases[kind]
+        scale = self.scales.get(complexity(board, expected), 1.0) * self.tier_scales.get(tier, 1.0)
+        if scale == 1.0:
+            return base
+        assert base.time is not None and base.nodes is not None
+        return Limit(depth = base.depth, time = base.time * scale, nodes = max(1, int(base.nodes * scale)))
+
+    def signature(self) -> str:
+        """
+        identifies the limits this policy gives, "fixed" for the base limits
+        """
+        if not self.scales and not self.tier_scales and self.bases == BASE_LIMITS:
+            return "fixed"
+        data = {
+            "scales": self.scales,
+            "tier_scales": self.tier_scales,
+            "base": {kind: [limit.depth, limit.time, limit.nodes] for kind, limit in sorted(self.bases.items())},
+        }
+        return hashlib.sha1(json.dumps(data, sort_keys = True).encode()).hexdigest()[:12]
+
+    @staticmethod
+    def fixed() -> "LimitPolicy":
+        return LimitPolicy({}, {})
+
+    @staticmethod
+    def load(path: str) -> "LimitPolicy":
+        with open(path) as f:
+            data = json.load(f)
+        bases = dict(BASE_LIMITS)
+        for kind, limit in data.get("base", {}).items():
+            bases[kind] = Limit(depth = limit.get("depth"), time = limit.get("time"), nodes = limit.get("nodes"))
+        return LimitPolicy(data["scales"], {int(tier): scale for tier, scale in data["tier_scales"].items()}, bases)
+
+    def save(self, path: str, samples: Dict[str, int]) -> None:
+        base = {kind: {"depth": limit.depth, "time": limit.time, "nodes": limit.nodes} for kind, limit in self.bases.items()}
+        with open(path, "w") as f:
+            json.dump({"scales": self.scales, "tier_scales": self.tier_scales, "base": base, "samples": samples}, f, indent = 2)
+
+
+def make_policy(spec: str) -> LimitPolicy:
+    """
+    `spec` is "fixed", "adaptive" or a file written by limits.py
+    """
+    if spec == "fixed":
+        return LimitPolicy.fixed()
+    if spec == "adaptive":
+        return LimitPolicy()
+    return LimitPolicy.load(spec)
+
+
+def settle_nodes(engine: chess.engine.SimpleEngine, board: Board, limit: Limit) -> int:
+    """
+    nodes searched when the best move of a 2 PV search last changed
+    """
+    best, settled = None, 0
+    with engine.analysis(board, limit, multipv = 2) as analysis:
+        for info in analysis:
+            if info.get("multipv", 1) == 1 and "pv" in info and "nodes" in info and info["pv"][0] != best:
+                best, settled = info["pv"][0], info["nodes"]
+    return settled
+
+def quantile(values: List[int], q: float) -> int:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def calibrate(samples: Dict[str, List[int]], margin: float = 2.0, min_samples: int = 20) -> LimitPolicy:
+    policy = LimitPolicy()
+    base_nodes = BASE_LIMITS["pair"].nodes
+    assert base_nodes
+    for cls, nodes in samples.items():
+        if len(nodes) >= min_samples:
+            policy.scales[cls] = round(min(MAX_SCALE, max(0.05, margin * quantile(nodes, 0.9) / base_nodes)), 3)
+        else:
+            logger.info(f"Only {len(nodes)} {cls} positions, keeping scale {policy.scales[cls]}")
+    return policy
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='limits.py',
+        description='calibrates the search limit of each position class on a sample of games')
+    parser.add_argument("--file", "-f", help="sample PGN file", required=True, metavar="FILE.pgn")
+    parser.add_argument("--sample", help="how many games with evals to use from the sample file", default="200")
+    parser.add_argument("--engine", "-e", help="analysis engine", default="./stockfish")
+    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--output", "-o", help="where to write the limits", default="limits.json")
+    return parser.parse_args()
+
+
+def main() -> None:
+    from generator import Generator, make_engine, logger as generator_logger
+    from mainline import decode_eval
+    from server import Server
+    from tune import read_sample
+    from util import decode_move
+    args = parse_args()
+    logger.setLevel(logging.INFO)
+    generator_logger.setLevel(logging.WARNING)
+    engine = make_engine(args.engine, int(args.threads))
+    # only used to screen positions like the generator does
+    generator = Generator(engine, Server(generator_logger, "", "", 0))
+    base = BASE_LIMITS["pair"]
+    assert base.time is not None and base.nodes is not None
+    limit = Limit(depth = base.depth, time = base.time * MAX_SCALE, nodes = int(base.nodes * MAX_SCALE))
+    samples: Dict[str, List[int]] = {cls: [] for cls in CLASSES}
+    for tier, mainline in read_sample(args.file, int(args.sample)):
+        board = mainline.board()
+        prev_score: Score = chess.engine.Cp(20)
+        for code, value in zip(mainline.moves, mainline.evals):
+            board.push(decode_move(code))
+            current_eval = decode_eval(value)
+            if current_eval is None:
+                break
+            score = current_eval.pov(board.turn)
+            if generator.screen_position(board, prev_score, score, tier):
+                samples[complexity(board, score)].append(settle_nodes(engine.engine, board, limit))
+            prev_score = -score
+    engine.close()
+    policy = calibrate(samples)
+    policy.save(args.output, {cls: len(nodes) for cls, nodes in samples.items()})
+    logger.info(f"Limits written to {args.output}: {policy.scales}")
+
+
+if __name__ == "__main__":
+    main()
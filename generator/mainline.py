@@ -0,0 +1,175 @@
+import logging
+import struct
+import chess
+import chess.pgn
+from array import array
+from dataclasses import dataclass, field
+from io import StringIO
+from chess import Board, WHITE
+from chess.engine import PovScore, Cp, Mate, MateGiven
+from chess.pgn import Game, GameNode
+from typing import Dict, List, Optional, Tuple
+from util import encode_move, decode_move
+
+logger = logging.getLogger(__name__)
+
+# evals are stored as int16 from white's point of view
+MATE_BASE = 32767
+MATE_THRESHOLD = 31000
+MAX_CP = 30000
+NO_EVAL = -32768
+
+def encode_eval(score: Optional[PovScore]) -> int:
+    if score is None:
+        return NO_EVAL
+    white = score.white()
+    mate = white.mate()
+    if mate == 0:
+        return MATE_BASE if white == MateGiven else -MATE_BASE
+    if mate is not None:
+        return MATE_BASE - mate if mate > 0 else -MATE_BASE - mate
+    cp = white.score()
+    assert cp is not None
+    return max(-MAX_CP, min(MAX_CP, cp))
+
+def decode_eval(value: int) -> Optional[PovScore]:
+    if value == NO_EVAL:
+        return None
+    if value == MATE_BASE:
+        return PovScore(MateGiven, WHITE)
+    if value > MATE_THRESHOLD:
+        return PovScore(Mate(MATE_BASE - value), WHITE)
+    if value < -MATE_THRESHOLD:
+        return PovScore(Mate(-MATE_BASE - value), WHITE)
+    return PovScore(Cp(value), WHITE)
+
+
+@dataclass
+class Mainline:
+    """
+    Compact mainline of a game: 16-bit encoded moves and the int16 eval after each of them
+    """
+    headers: Dict[str, str]
+    moves: array = field(default_factory = lambda: array("H"))
+    evals: array = field(default_factory = lambda: array("h"))
+
+    def game_id(self) -> str:
+        return self.headers.get("Site", "?")[20:]
+
+    def board(self) -> Board:
+        fen = self.headers.get("FEN")
+        return Board(fen) if fen else Board()
+
+    def nodes(self) -> "MainlineNodes":
+        return MainlineNodes(self)
+
+    @staticmethod
+    def from_game(game: Game) -> "Mainline":
+        mainline = Mainline(dict(game.headers))
+        for node in game.mainline():
+            mainline.moves.append(encode_move(node.move))
+            mainline.evals.append(encode_eval(node.eval()))
+        return mainline
+
+    def pack(self) -> bytes:
+        headers = "\n".join(f"{k}\t{v}" for k, v in self.headers.items()).encode()
+        return b"".join([
+            struct.pack("<II", len(headers), len(self.moves)),
+            headers,
+            self.moves.tobytes(),
+            self.evals.tobytes()
+        ])
+
+    @staticmethod
+    def unpack(buf: memoryview) -> Tuple["Mainline", int]:
+        """
+        reads one packed mainline from the start of `buf`, returns it with the count of bytes read
+        """
+        header_size, nb_moves = struct.unpack_from("<II", buf)
+        offset = 8
+        text = bytes(buf[offset:offset + header_size]).decode()
+        headers = dict(line.split("\t", 1) for line in text.split("\n")) if text else {}
+        offset += header_size
+        moves = array("H")
+        moves.frombytes(buf[offset:offset + 2 * nb_moves])
+        offset += 2 * nb_moves
+        evals = array("h")
+        evals.frombytes(buf[offset:offset + 2 * nb_moves])
+        offset += 2 * nb_moves
+        return Mainline(headers, moves, evals), offset
+
+
+class MainlineNodes:
+    """
+    Builds the python-chess game tree of a mainline on demand, one ply further each time
+    """
+
+    def __init__(self, mainline: Mainline) -> None:
+        self.mainline = mainline
+        self.game = Game()
+        for k, v in mainline.headers.items():
+            self.game.headers[k] = v
+        self.node: GameNode = self.game
+        self.ply = 0
+
+    def at(self, ply: int) -> GameNode:
+        assert ply >= self.ply
+        while self.ply < ply:
+            self.node = self.node.add_main_variation(decode_move(self.mainline.moves[self.ply]))
+            self.ply += 1
+        return self.node
+
+
+class MainlineVisitor(chess.pgn.BaseVisitor[Mainline]):
+    """
+    Records mainline moves and evals straight into a Mainline: variations are skipped,
+    other comments (clocks) are dropped and no game node is built.
+    Games with an illegal or malformed move give no mainline.
+    """
+
+    def begin_game(self) -> None:
+        self.mainline = Mainline({})
+        self.white_to_move = True
+        self.errored = False
+
+    def visit_header(self, tagname: str, tagvalue: str) -> None:
+        self.mainline.headers[tagname] = tagvalue
+
+    def visit_board(self, board: Board) -> None:
+        self.white_to_move = board.turn == WHITE
+
+    def visit_move(self, board: Board, move: chess.Move) -> None:
+        self.mainline.moves.append(encode_move(move))
+        self.mainline.evals.append(NO_EVAL)
+        self.white_to_move = not self.white_to_move
+
+    def visit_comment(self, comment: str) -> None:
+        if not self.mainline.moves or "%eval" not in comment:
+            return
+        match = chess.pgn.EVAL_REGEX.search(comment)
+        if not match:
+            return
+        if match.group(1):
+            mate = int(match.group(1))
+            if mate == 0:
+                # the side to move has been mated
+                value = -MATE_BASE if self.white_to_move else MATE_BASE
+            else:
+                value = MATE_BASE - mate if mate > 0 else -MATE_BASE - mate
+        else:
+            value = max(-MAX_CP, min(MAX_CP, int(float(match.group(2)) * 100)))
+        self.mainline.evals[-1] = value
+
+    def begin_variation(self) -> chess.pgn.SkipType:
+        return chess.pgn.SKIP
+
+    def handle_error(self, error: Exception) -> None:
+        logger.warning("Skipping {}: {}".format(self.mainline.headers.get("Site", "?"), error))
+        self.errored = True
+
+    def result(self) -> Optional[Mainline]: # type: ignore
+        return None if self.errored else self.mainline
+
+
+def parse_game(text: str) -> Optional[Mainline]:
+    return chess.pgn.read_game(StringIO(text), Visitor = MainlineVisitor)
@@ -0,0 +1,39 @@
+import gc
+import logging
+import tracemalloc
+from collections import Counter
+from typing import Dict
+
+# object types worth following across a long run
+TRACKED_TYPES = {"Game", "ChildNode", "Board", "Mainline", "NextMovePair", "Puzzle"}
+
+class MemoryReport:
+    """
+    Opt-in memory report logged every `every` games: the top allocation sites according
+    to tracemalloc, live counts of the tracked object types and the sizes of the pipeline stages.
+    """
+
+    def __init__(self, logger: logging.Logger, every: int, top: int = 10, frames: int = 1) -> None:
+        self.logger = logger
+        self.every = every
+        self.top = top
+        self.games = 0
+        tracemalloc.start(frames)
+
+    def tick(self, stages: Dict[str, int]) -> None:
+        self.games += 1
+        if self.games % self.every == 0:
+            self.report(stages)
+
+    def report(self, stages: Dict[str, int]) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Memory after {self.games} games: {current >> 20} MB traced, {peak >> 20} MB peak"]
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:self.top]:
+            lines.append(f"  {stat.size >> 10} KB in {stat.count} blocks at {stat.traceback}")
+        objects = Counter(type(o).__name__ for o in gc.get_objects())
+        lines.append("  objects: " + ", ".join(f"{name} {objects[name]}" for name in sorted(TRACKED_TYPES)))
+        lines.append("  stages: " + ", ".join(f"{name} {size}" for name, size in stages.items()))
+        self.logger.info("\n".join(lines))
+
+    def close(self) -> None:
+        tracemalloc.stop()
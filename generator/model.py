@@ -27,3 +27,5 @@ class NextMovePair:
     winner: Color
     best: EngineMove
     second: Optional[EngineMove]
+    # expected reply to the best move, from its principal variation
+    ponder: Optional[Move] = None
@@ -0,0 +1,97 @@
+import multiprocessing
+import multiprocessing.pool
+import struct
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from mainline import Mainline, parse_game
+
+T = TypeVar("T")
+
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def parse_batch(texts: List[str]) -> Tuple[str, int]:
+    """
+    Runs in a parser process: packs the mainlines of `texts` in a new shared memory block,
+    returns its name and size. The reading side unlinks it.
+    """
+    packed = []
+    for text in texts:
+        mainline = parse_game(text)
+        packed.append(mainline.pack() if mainline else b"")
+    data = b"".join(struct.pack("<I", len(p)) + p for p in packed)
+    shm = shared_memory.SharedMemory(create = True, size = max(len(data), 1))
+    shm.buf[:len(data)] = data
+    name = shm.name
+    shm.close()
+    # the reading process owns the block from now on
+    resource_tracker.unregister(shm._name, "shared_memory") # type: ignore
+    return name, len(data)
+
+def read_batch(name: str, size: int) -> List[Optional[Mainline]]:
+    shm = shared_memory.SharedMemory(name = name)
+    try:
+        buf = shm.buf[:size]
+        mainlines: List[Optional[Mainline]] = []
+        offset = 0
+        while offset < size:
+            (length,) = struct.unpack_from("<I", buf, offset)
+            offset += 4
+            mainlines.append(Mainline.unpack(buf[offset:offset + length])[0] if length else None)
+            offset += length
+        buf.release()
+        return mainlines
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class ParserPool:
+    """
+    Parses game texts into mainlines in worker processes, keeping the engine driving
+    process free. Results come back in submission order, with at most `in_flight`
+    batches pending.
+    Workers are started by a fork server rather than forked from the caller, which may already
+    run engine processes and threads: a forked child would inherit their pipes and held locks.
+    """
+
+    def __init__(self, processes: int, batch_size: int = 64, in_flight: int = 0) -> None:
+        self.pool = multiprocessing.get_context(START_METHOD).Pool(processes) if processes > 0 else None
+        self.batch_size = batch_size
+        self.in_flight = in_flight or max(2 * processes, 1)
+        self.pending_batches = 0
+
+    def parse(self, items: Iterable[Tuple[T, str]]) -> Iterator[Tuple[T, Optional[Mainline]]]:
+        if self.pool is None:
+            for payload, text in items:
+                yield payload, parse_game(text)
+            return
+        pending: Deque[Tuple[List[T], "multiprocessing.pool.AsyncResult[Tuple[str, int]]"]] = deque()
+        batch: List[Tuple[T, str]] = []
+
+        def submit() -> None:
+            assert self.pool
+            pending.append(([p for p, _ in batch], self.pool.apply_async(parse_batch, ([t for _, t in batch],))))
+            batch.clear()
+            self.pending_batches = len(pending)
+
+        def collect() -> Iterator[Tuple[T, Optional[Mainline]]]:
+            payloads, result = pending.popleft()
+            self.pending_batches = len(pending)
+            yield from zip(payloads, read_batch(*result.get()))
+
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                submit()
+                if len(pending) >= self.in_flight:
+                    yield from collect()
+        if batch:
+            submit()
+        while pending:
+            yield from collect()
+
+    def close(self) -> None:
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
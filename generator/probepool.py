@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+import chess
+from concurrent.futures import Future, ThreadPoolExecutor
+from chess.engine import Limit, InfoDict, PlayResult
+from typing import Any, Callable, Dict, List, Optional, TypeVar, Union, TYPE_CHECKING
+from budget import BudgetExceeded
+from model import Puzzle
+from supervisor import SupervisedEngine
+
+if TYPE_CHECKING:
+    from generator import Generator, Candidate
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class Cancelled(Exception):
+    pass
+
+
+class CancellableEngine:
+    """
+    Refuses new searches once the probe it serves has been cancelled,
+    and ends the search already running when told to stop.
+    """
+
+    def __init__(self, engine: SupervisedEngine) -> None:
+        self.engine = engine
+        self.cancelled: Optional[threading.Event] = None
+        # held while checking or flagging the running search, so that a stop can't miss one
+        self.lock = threading.Lock()
+        self.searching = False
+
+    def check(self) -> None:
+        if self.cancelled and self.cancelled.is_set():
+            raise Cancelled()
+
+    def search(self, call: Callable[[], T]) -> T:
+        with self.lock:
+            self.check()
+            self.searching = True
+        try:
+            result = call()
+        finally:
+            with self.lock:
+                self.searching = False
+        # a stopped search only returns what it found so far
+        self.check()
+        return result
+
+    def stop(self, cancelled: threading.Event) -> None:
+        """
+        ends the running search if it belongs to the `cancelled` probe
+        """
+        with self.lock:
+            if self.searching and self.cancelled is cancelled:
+                self.engine.stop()
+
+    def analyse(self, board: chess.Board, limit: Limit, **kwargs: Any) -> Union[InfoDict, List[InfoDict]]:
+        return self.search(lambda: self.engine.analyse(board, limit, **kwargs))
+
+    def play(self, board: chess.Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        return self.search(lambda: self.engine.play(board, limit, **kwargs))
+
+    def close(self) -> None:
+        self.engine.close()
+
+
+class ProbePool:
+    """
+    Probes all the candidates of a game at once, one per prober: generators with their own
+    CancellableEngine, budgets and tablebase. The puzzle of the earliest candidate wins like
+    when probing one after another: later candidates are cancelled as soon as it is found,
+    and an earlier candidate is always waited for.
+    Budgets are per prober, a game allowance only bounds what one prober spends on the game.
+    """
+
+    def __init__(self, probers: List["Generator"]) -> None:
+        self.probers = probers
+        self.idle: "queue.Queue[Generator]" = queue.Queue()
+        for prober in probers:
+            self.idle.put(prober)
+        # the game each prober last probed, as the cancel event of that game
+        self.games: Dict[int, threading.Event] = {}
+        self.executor = ThreadPoolExecutor(len(probers), thread_name_prefix = "prober")
+
+    def probe(self, candidate: "Candidate", tier: int, cancelled: threading.Event) -> Optional[Puzzle]:
+        if cancelled.is_set():
+            return None
+        prober = self.idle.get()
+        engine = prober.engine.engine
+        assert isinstance(engine, CancellableEngine)
+        engine.cancelled = cancelled
+        try:
+            if self.games.get(id(prober)) is not cancelled:
+                self.games[id(prober)] = cancelled
+                prober.budgets.start_game()
+            result = prober.probe_position(candidate.node, candidate.kind, candidate.prev_score, candidate.score, tier)
+            return result if isinstance(result, Puzzle) else None
+        except BudgetExceeded as e:
+            prober.budgets.abandon(candidate.node.game().headers.get("Site", "?")[20:], candidate.ply, e)
+            return None
+        except Cancelled:
+            return None
+        finally:
+            engine.cancelled = None
+            self.idle.put(prober)
+
+    def first_puzzle(self, candidates: List["Candidate"], tier: int) -> Optional[Puzzle]:
+        cancelled = threading.Event()
+        futures: List[Future] = [self.executor.submit(self.probe, candidate, tier, cancelled) for candidate in candidates]
+        try:
+            for future in futures:
+                puzzle = future.result()
+                if puzzle:
+                    return puzzle
+            return None
+        finally:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            # the candidates already being probed return at their next search, or now if searching
+            for prober in self.probers:
+                prober.engine.engine.stop(cancelled)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for prober in self.probers:
+            prober.close_engines()
@@ -0,0 +1,103 @@
+"""
+Statistical stack sampler for long runs, toggled by SIGUSR1 or by creating/removing a control file.
+When stopped, it writes flamegraph.pl compatible collapsed stacks to profile-PID-TIME.folded.
+Samples are rooted at "engine-wait" when the sampled thread is blocked on the engine, directly or through
+the probe pool, speculator or annotator futures, "python" otherwise.
+Shared by the generator and the tagger: tagger/profiler.py links to this file.
+
+    kill -USR1 <pid>   # start
+    kill -USR1 <pid>   # stop and write
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+WAIT_FILES = ("threading.py", os.path.join("concurrent", "futures", "_base.py"))
+# a thread blocked under one of these is waiting for engine searches, in its own thread or in pool threads
+ENGINE_FILES = (os.path.join("chess", "engine.py"), "probepool.py", "speculation.py", "annotate.py")
+
+def collapse(frame: Optional[FrameType]) -> str:
+    frames = []
+    engine = False
+    while frame:
+        code = frame.f_code
+        engine = engine or code.co_filename.endswith(ENGINE_FILES)
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    waiting = engine and bool(frames) and any(frames[0].startswith(os.path.basename(f) + ":") for f in WAIT_FILES)
+    frames.append("engine-wait" if waiting else "python")
+    return ";".join(reversed(frames))
+
+
+class Profiler:
+
+    def __init__(self, interval: float = 0.01, output_dir: str = ".", control_file: Optional[str] = None) -> None:
+        self.interval = interval
+        self.output_dir = output_dir
+        self.control_file = control_file
+        self.target = threading.get_ident()
+        self.stacks: Counter = Counter()
+        self.sampling = threading.Event()
+        self.sampler: Optional[threading.Thread] = None
+        self.toggle_requested = threading.Event()
+        self.started_at = 0.0
+
+    def install(self) -> None:
+        """
+        profiles the calling thread from now on, whenever asked to
+        """
+        self.target = threading.get_ident()
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_requested.set())
+        threading.Thread(target = self._control, name = "profiler control", daemon = True).start()
+
+    def _control(self) -> None:
+        present = False
+        while True:
+            toggle = self.toggle_requested.wait(1)
+            self.toggle_requested.clear()
+            if self.control_file and os.path.exists(self.control_file) != present:
+                present = not present
+                toggle = present != self.sampling.is_set()
+            if toggle:
+                if self.sampling.is_set():
+                    self.stop()
+                else:
+                    self.start()
+
+    def start(self) -> None:
+        logger.warning(f"Profiler started in {os.getpid()}")
+        self.stacks = Counter()
+        self.started_at = time.time()
+        self.sampling.set()
+        self.sampler = threading.Thread(target = self._sample, name = "profiler", daemon = True)
+        self.sampler.start()
+
+    def _sample(self) -> None:
+        while self.sampling.is_set():
+            frame = sys._current_frames().get(self.target)
+            if frame:
+                self.stacks[collapse(frame)] += 1
+            time.sleep(self.interval)
+
+    def stop(self) -> None:
+        self.sampling.clear()
+        # the sampler writes to the stacks until it sees the flag
+        if self.sampler:
+            self.sampler.join()
+            self.sampler = None
+        path = os.path.join(self.output_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        waiting = sum(count for stack, count in self.stacks.items() if stack.startswith("engine-wait"))
+        total = sum(self.stacks.values()) or 1
+        logger.warning(f"Profiler stopped after {round(time.time() - self.started_at)}s, {round(100 * waiting / total)}% engine wait, written to {path}")
@@ -0,0 +1,61 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+@dataclass
+class Cost:
+    count: int = 0
+    nodes: int = 0
+    time: float = 0.0 # seconds
+
+    def add(self, other: "Cost") -> None:
+        self.count += other.count
+        self.nodes += other.nodes
+        self.time += other.time
+
+
+class Rejections:
+    """
+    Counts why positions were not turned into puzzles, per reason and tier, with the engine
+    nodes and time spent on them, to find the filters that burn engine time for nothing.
+    The summary is logged every `every` games, and on demand.
+    """
+
+    def __init__(self, logger: logging.Logger, every: int = 0) -> None:
+        self.logger = logger
+        self.every = every
+        self.games = 0
+        self.costs: Dict[Tuple[str, int], Cost] = defaultdict(Cost)
+
+    def start_game(self) -> None:
+        if self.every and self.games and self.games % self.every == 0:
+            self.report()
+        self.games += 1
+
+    def record(self, reason: str, tier: int, nodes: int = 0, seconds: float = 0) -> None:
+        cost = self.costs[(reason, tier)]
+        cost.count += 1
+        cost.nodes += nodes
+        cost.time += seconds
+
+    def by_reason(self) -> Dict[str, Cost]:
+        reasons: Dict[str, Cost] = defaultdict(Cost)
+        for (reason, _), cost in self.costs.items():
+            reasons[reason].add(cost)
+        return reasons
+
+    def report(self) -> None:
+        reasons = self.by_reason()
+        total = Cost()
+        for cost in reasons.values():
+            total.add(cost)
+        puzzles = reasons["puzzle"].count if "puzzle" in reasons else 0
+        header = f"Rejections after {self.games} games: {puzzles} puzzles, engine total {total.nodes // 1000}k nodes {round(total.time, 1)}s"
+        if puzzles:
+            header += f", {total.nodes // puzzles // 1000}k nodes {round(total.time / puzzles, 1)}s per puzzle"
+        lines = [header]
+        for reason, cost in sorted(reasons.items(), key = lambda r: (-r[1].time, -r[1].count)):
+            tiers = ", ".join(f"t{tier} {c.count}" for (r, tier), c in sorted(self.costs.items()) if r == reason)
+            lines.append(f"  {reason}: {cost.count} ({tiers}), {cost.nodes // 1000}k nodes, {round(cost.time, 1)}s")
+        self.logger.info("\n".join(lines))
@@ -1,6 +1,8 @@
 import logging
 from chess.pgn import Game, GameNode, ChildNode
 from model import Puzzle
+from typing import Set
+from util import position_key
 import requests
 import urllib.parse
 from requests.adapters import HTTPAdapter
@@ -21,11 +23,15 @@ TIMEOUT = 5
 
 class Server:
 
-    def __init__(self, logger: logging.Logger, url: str, token: str, version: int) -> None:
+    def __init__(self, logger: logging.Logger, url: str, token: str, version: int, max_seen_positions: int = 1_000_000) -> None:
         self.logger = logger
         self.url = url
         self.token = token
         self.version = version
+        # two generations of seen position keys, the older one is dropped when the newer one is full
+        self.seen_positions: Set[int] = set()
+        self.old_seen_positions: Set[int] = set()
+        self.max_seen_positions = max_seen_positions
 
     def is_seen(self, id: str) -> bool:
         if not self.url:
@@ -44,16 +50,29 @@ class Server:
         except Exception as e:
             self.logger.error(e)
 
+    # positions of known puzzles are remembered locally by zobrist key, the server only knows them by FEN.
+    # Rejected positions are not: they may still give a puzzle at a higher tier.
     def is_seen_pos(self, node: ChildNode) -> bool:
+        key = position_key(node)
+        if key in self.seen_positions or key in self.old_seen_positions:
+            return True
         if not self.url:
             return False
         id = urllib.parse.quote(f"{node.parent.board().fen()}:{node.uci()}")
         try:
             status = http.get(self._seen_url(id), timeout = TIMEOUT).status_code
-            return status == 200
         except Exception as e:
             self.logger.error(e)
             return False
+        if status == 200:
+            self.set_seen_pos(node)
+        return status == 200
+
+    def set_seen_pos(self, node: ChildNode) -> None:
+        if len(self.seen_positions) >= self.max_seen_positions:
+            self.old_seen_positions = self.seen_positions
+            self.seen_positions = set()
+        self.seen_positions.add(position_key(node))
 
     def _seen_url(self, id: str) -> str:
         return "{}/seen?token={}&id={}".format(self.url, self.token, id)
@@ -61,6 +80,7 @@ class Server:
     def post(self, game_id: str, puzzle: Puzzle) -> None:
         parent = puzzle.node.parent
         assert parent
+        self.set_seen_pos(puzzle.node)
         json = {
             'game_id': game_id,
             'fen': parent.board().fen(),
@@ -0,0 +1,76 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from chess import Board
+from chess.engine import Limit, InfoDict
+from chess.polyglot import zobrist_hash
+from typing import List, Optional, Tuple
+from budget import Budget, BudgetExceeded, BudgetManager, info_nodes
+from supervisor import SupervisedEngine
+from util import analyse_pair
+
+logger = logging.getLogger(__name__)
+
+class Speculator:
+    """
+    Second engine analysing the position two plies ahead predicted by the principal variation,
+    while the main engine searches the reply in between. The result is only used if the line
+    reaches the predicted position.
+    A search is charged to the budgets of the candidate that started it, and only starts if they cover it.
+    """
+
+    def __init__(self, engine: SupervisedEngine, budgets: Optional[BudgetManager] = None) -> None:
+        self.engine = engine
+        self.budgets = budgets
+        # one search at a time, a wrong guess is stopped when discarded
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix = "speculator")
+        self.pending: Optional[Tuple[int, "Future[List[InfoDict]]"]] = None
+        self.hits = 0
+        self.misses = 0
+
+    def speculate(self, board: Board, limit: Limit) -> None:
+        self.discard()
+        budgets: List[Budget] = []
+        if self.budgets:
+            try:
+                self.budgets.check(limit)
+            except BudgetExceeded:
+                return
+            budgets = self.budgets.current()
+        self.pending = (zobrist_hash(board), self.executor.submit(self.search, board.copy(), limit, budgets))
+
+    def search(self, board: Board, limit: Limit, budgets: List[Budget]) -> List[InfoDict]:
+        start = time.monotonic()
+        info = analyse_pair(self.engine, board, limit)
+        if self.budgets:
+            self.budgets.charge(info_nodes(info), time.monotonic() - start, budgets)
+        return info
+
+    def take(self, board: Board) -> Optional[List[InfoDict]]:
+        """
+        the speculative analysis of `board`, if that's the predicted position
+        """
+        if not self.pending or self.pending[0] != zobrist_hash(board):
+            return None
+        _, future = self.pending
+        self.pending = None
+        try:
+            info = future.result()
+        except Exception as e:
+            logger.debug("Speculative search failed: {}".format(e))
+            self.misses += 1
+            return None
+        self.hits += 1
+        return info
+
+    def discard(self) -> None:
+        if self.pending:
+            # a wrong guess already searching would hold the engine until its limit
+            if not self.pending[1].cancel():
+                self.engine.stop()
+            self.pending = None
+            self.misses += 1
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.engine.close()
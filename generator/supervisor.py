@@ -0,0 +1,148 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import threading
+import time
+import chess
+import chess.engine
+from chess.engine import SimpleEngine, Limit, InfoDict, PlayResult, ConfigMapping
+from leanuci import popen_lean_uci
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from budget import BudgetedEngine
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class Watchdog:
+    """
+    One thread calling back the calls armed with a deadline that are still running when it passes,
+    shared by all the engines of the process
+    """
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.armed: Dict[int, Tuple[float, Callable[[], None]]] = {}
+        self.tokens = itertools.count()
+        self.thread: Optional[threading.Thread] = None
+
+    def arm(self, seconds: float, callback: Callable[[], None]) -> int:
+        with self.condition:
+            token = next(self.tokens)
+            self.armed[token] = (time.monotonic() + seconds, callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target = self._run, name = "engine-watchdog", daemon = True)
+                self.thread.start()
+            self.condition.notify()
+            return token
+
+    def disarm(self, token: int) -> None:
+        with self.condition:
+            self.armed.pop(token, None)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                expired = [token for token, (deadline, _) in self.armed.items() if deadline <= now]
+                callbacks = [self.armed.pop(token)[1] for token in expired]
+                if not callbacks:
+                    next_deadline = min((deadline for deadline, _ in self.armed.values()), default = None)
+                    self.condition.wait(None if next_deadline is None else next_deadline - now)
+                    continue
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"Watchdog callback failed: {e!r}")
+
+watchdog = Watchdog()
+
+
+class SupervisedEngine:
+    """
+    Wraps a SimpleEngine, restarting it with the same options when the process dies
+    or a search runs well past its time limit. The interrupted call is retried once.
+    With `lean`, analyse only parses the final info line of each PV.
+    """
+
+    def __init__(self, executable: str, options: ConfigMapping, hang_factor: float = 2, hang_grace: float = 30, untimed_deadline: float = 600, lean: bool = False) -> None:
+        self.executable = executable
+        self.options = dict(options)
+        self.lean = lean
+        self.hang_factor = hang_factor
+        self.hang_grace = hang_grace
+        self.untimed_deadline = untimed_deadline
+        self.restarts = 0
+        self.engine = self._start()
+
+    def _start(self) -> SimpleEngine:
+        engine = popen_lean_uci(self.executable) if self.lean else SimpleEngine.popen_uci(self.executable)
+        engine.configure(self.options)
+        # the watchdog below owns search deadlines
+        engine.timeout = None
+        return engine
+
+    def name(self) -> str:
+        return self.engine.id.get("name", self.executable)
+
+    def restart(self) -> None:
+        self.restarts += 1
+        logger.warning(f"Restarting engine {self.executable} ({self.restarts} restarts so far)")
+        self.engine.close()
+        self.engine = self._start()
+
+    def deadline_for(self, limit: Optional[Limit]) -> float:
+        if limit is None or limit.time is None:
+            return self.untimed_deadline
+        return limit.time * self.hang_factor + self.hang_grace
+
+    def _supervise(self, call: Callable[[SimpleEngine], T], limit: Optional[Limit]) -> T:
+        for attempt in range(2):
+            engine = self.engine
+            if engine.returncode.done():
+                logger.error(f"Engine died with code {engine.returncode.result()}")
+                self.restart()
+                engine = self.engine
+            hung = threading.Event()
+            def kill() -> None:
+                hung.set()
+                engine.close()
+            token = watchdog.arm(self.deadline_for(limit), kill)
+            try:
+                return call(engine)
+            except (chess.engine.EngineError, chess.engine.EngineTerminatedError, asyncio.TimeoutError, concurrent.futures.TimeoutError) as e:
+                if attempt > 0:
+                    raise
+                logger.error("Hung search, retrying" if hung.is_set() else f"Engine failure {e!r}, retrying")
+                self.restart()
+            finally:
+                watchdog.disarm(token)
+        raise AssertionError("unreachable")
+
+    def analyse(self, board: chess.Board, limit: Limit, **kwargs: Any) -> Union[InfoDict, List[InfoDict]]:
+        return self._supervise(lambda engine: engine.analyse(board, limit, **kwargs), limit)
+
+    def play(self, board: chess.Board, limit: Limit, **kwargs: Any) -> PlayResult:
+        return self._supervise(lambda engine: engine.play(board, limit, **kwargs), limit)
+
+    def stop(self) -> None:
+        """
+        asks the running search, if any, to end now: analyse and play then return what the engine found so far.
+        Callable from any thread, the engine ignores it when idle.
+        """
+        engine = self.engine
+        engine.protocol.loop.call_soon_threadsafe(engine.protocol.send_line, "stop")
+
+    def configure(self, options: ConfigMapping) -> None:
+        self.options.update(options)
+        self._supervise(lambda engine: engine.configure(options), None)
+
+    def close(self) -> None:
+        self.engine.close()
+
+
+Engine = Union[SimpleEngine, SupervisedEngine, "BudgetedEngine"]
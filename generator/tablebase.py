@@ -0,0 +1,96 @@
+import chess
+import chess.syzygy
+from chess import Board, Color, Move
+from chess.engine import Score, PovScore, Cp, Mate
+from chess.pgn import GameNode
+from model import EngineMove, NextMovePair
+from typing import List, Optional, Tuple
+
+# tablebase wins too long to follow to mate are scored like a big engine advantage
+TB_WIN = Cp(20000)
+
+# (how good the move is for the side playing it, move)
+RankedMove = Tuple[Tuple[int, int], Move]
+
+class Tablebase:
+    """
+    Exact answers for small material positions from local Syzygy tables.
+    Every method returns None when a table is missing, so that the caller falls back to the engine.
+    """
+
+    def __init__(self, path: str, max_pieces: int = 7, mate_plies: int = 30) -> None:
+        self.tablebase = chess.syzygy.open_tablebase(path)
+        self.max_pieces = max_pieces
+        self.mate_plies = mate_plies
+
+    def covers(self, board: Board) -> bool:
+        return chess.popcount(board.occupied) <= self.max_pieces and not board.castling_rights
+
+    def rank_moves(self, board: Board) -> Optional[List[RankedMove]]:
+        ranked = []
+        for move in board.legal_moves:
+            board.push(move)
+            try:
+                if board.is_checkmate():
+                    key = (3, 0)
+                else:
+                    wdl = self.tablebase.get_wdl(board)
+                    dtz = self.tablebase.get_dtz(board)
+                    if wdl is None or dtz is None:
+                        return None
+                    # from the point of view of the side playing the move
+                    wdl = -wdl
+                    # win fast, lose slowly
+                    key = (2, -abs(dtz)) if wdl == 2 else (-2, abs(dtz)) if wdl == -2 else (wdl, 0)
+            finally:
+                board.pop()
+            ranked.append((key, move))
+        return sorted(ranked, key = lambda r: r[0], reverse = True)
+
+    def mate_plies_after(self, board: Board) -> Optional[int]:
+        """
+        plies to mate following the tablebase line, when the side to move is getting mated
+        """
+        board = board.copy(stack = False)
+        for plies in range(self.mate_plies):
+            if board.is_checkmate():
+                return plies
+            ranked = self.rank_moves(board)
+            if not ranked:
+                return None
+            board.push(ranked[0][1])
+        return None
+
+    def score(self, board: Board, ranked: RankedMove) -> Score:
+        """
+        score of the ranked move, for the side playing it
+        """
+        (wdl, _), move = ranked
+        if wdl == 3:
+            return Mate(1)
+        if wdl == 2:
+            board.push(move)
+            plies = self.mate_plies_after(board)
+            board.pop()
+            return Mate(1 + (plies + 1) // 2) if plies is not None else TB_WIN
+        if wdl == -2:
+            return -TB_WIN
+        return Cp(0)
+
+    def next_move_pair(self, node: GameNode, winner: Color) -> Optional[NextMovePair]:
+        board = node.board()
+        ranked = self.rank_moves(board)
+        if not ranked:
+            return None
+        best = ranked[0]
+        second = ranked[1] if len(ranked) > 1 else None
+        def engine_move(r: RankedMove) -> EngineMove:
+            return EngineMove(r[1], PovScore(self.score(board, r), board.turn).pov(winner))
+        return NextMovePair(node, winner, engine_move(best), engine_move(second) if second else None)
+
+    def best_move(self, board: Board) -> Optional[Move]:
+        ranked = self.rank_moves(board)
+        return ranked[0][1] if ranked else None
+
+    def close(self) -> None:
+        self.tablebase.close()
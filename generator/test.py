@@ -1,15 +1,45 @@
 import unittest
 import logging
+import copy
+import os
+import tempfile
+from unittest import mock
+from io import StringIO
 import chess
 from model import Puzzle
 from generator import logger
 from server import Server
-from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
+from chess.engine import SimpleEngine, Mate, MateGiven, Cp, Score, PovScore
 from chess import Move, Color, Board, WHITE, BLACK
 from chess.pgn import Game, GameNode
-from typing import List, Optional, Tuple, Literal, Union
+from typing import Dict, List, Optional, Set, Tuple, Literal, Union
 
 from generator import Generator, Server, make_engine
+from util import encode_move, decode_move, position_key
+from mainline import Mainline, encode_eval, decode_eval, parse_game
+from parsing import ParserPool
+from leanuci import popen_lean_uci
+from supervisor import SupervisedEngine, Watchdog
+from speculation import Speculator
+from profiler import Profiler, collapse
+import argparse
+import batch
+import threading
+import sys
+from budget import Allowance, BudgetManager, BudgetedEngine, BudgetExceeded
+from tablebase import Tablebase, TB_WIN
+from rejections import Rejections
+from limits import LimitPolicy, complexity
+from verdicts import Verdict, VerdictCache
+from probepool import Cancelled, CancellableEngine, ProbePool
+from yieldmodel import YieldModel, features, hashed
+import numpy as np
+from generator import Candidate, adjusted_tier, verdict_context
+import time
+from gamecache import GameCache, MAGIC, write_record
+from annotate import annotate_game
+from dumpindex import DumpIndex, build_index, index_path
+import zstandard
 
 class TestGenerator(unittest.TestCase):
 
@@ -188,5 +218,876 @@ class TestGenerator(unittest.TestCase):
         cls.engine.close()
 
 
+class TestUtil(unittest.TestCase):
+
+    def test_encode_move(self) -> None:
+        for uci in ["e2e4", "a7a8q", "h2h1n", "e1g1"]:
+            move = Move.from_uci(uci)
+            self.assertEqual(decode_move(encode_move(move)), move)
+            self.assertLess(encode_move(move), 1 << 16)
+
+    def test_adjusted_tier(self) -> None:
+        self.assertEqual([adjusted_tier(1, moves) for moves in [20, 21, 37, 38]], [3, 2, 2, 1])
+
+    def test_position_key(self) -> None:
+        game = Game()
+        node = game.add_main_variation(Move.from_uci("e2e4"))
+        other = Game().add_main_variation(Move.from_uci("e2e3"))
+        self.assertEqual(position_key(node), position_key(copy.deepcopy(node)))
+        self.assertNotEqual(position_key(node), position_key(other))
+
+
+# answers every search with the same info lines, whatever the position
+SCRIPTED_ENGINE = """
+import sys
+LINES = [
+    "info depth 1 seldepth 1 multipv 1 score cp 20 nodes 20 nps 20000 time 1 pv e2e4",
+    "info depth 1 seldepth 1 multipv 2 score cp 10 nodes 20 nps 20000 time 1 pv d2d4",
+    "info depth 2 seldepth 3 multipv 1 score cp 35 lowerbound nodes 300 nps 30000 time 10 pv e2e4 e7e5",
+    "info string some engine chatter",
+    "info depth 3 seldepth 5 multipv 1 score mate 4 nodes 4000 nps 40000 hashfull 12 tbhits 0 time 100 pv g1f3 b8c6 e2e4",
+    "info depth 3 seldepth 4 multipv 2 score cp -250 upperbound nodes 4000 nps 40000 time 100 pv d2d4 d7d5",
+]
+for line in sys.stdin:
+    command = line.split()[0] if line.split() else ""
+    if command == "uci":
+        print("id name scripted")
+        print("option name MultiPV type spin default 1 min 1 max 500")
+        print("uciok")
+    elif command == "isready":
+        print("readyok")
+    elif command == "go":
+        print("\\n".join(LINES))
+        print("bestmove g1f3 ponder b8c6")
+    elif command == "quit":
+        break
+    sys.stdout.flush()
+"""
+
+class TestLeanUci(unittest.TestCase):
+
+    def test_same_as_stock_parsing(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "scripted.py")
+            with open(path, "w") as f:
+                f.write(SCRIPTED_ENGINE)
+            stock = SimpleEngine.popen_uci([sys.executable, path])
+            lean = popen_lean_uci([sys.executable, path])
+            try:
+                limit = chess.engine.Limit(depth = 3)
+                for multipv in [None, 1, 2]:
+                    stock_slots = stock.analyse(Board(), limit, multipv = multipv)
+                    lean_slots = lean.analyse(Board(), limit, multipv = multipv)
+                    if multipv is None:
+                        stock_slots, lean_slots = [stock_slots], [lean_slots]
+                    self.assertEqual(len(lean_slots), len(stock_slots))
+                    for stock_info, lean_info in zip(stock_slots, lean_slots):
+                        # stock parsing merges all the lines, keeping keys the final line doesn't have,
+                        # like a lowerbound of an earlier depth. The lean one only has the final line.
+                        self.assertEqual(lean_info, {k: v for k, v in stock_info.items() if k in lean_info or k not in ["string", "lowerbound", "upperbound"]})
+                        self.assertIn("pv", lean_info)
+                    self.assertNotIn("lowerbound", lean_slots[0])
+                    if multipv == 2:
+                        self.assertEqual(lean_slots[1]["score"], PovScore(Cp(-250), WHITE))
+                        self.assertTrue(lean_slots[1]["upperbound"])
+                scores = lean.analyse(Board(), limit, info = chess.engine.INFO_SCORE)
+                self.assertEqual(scores["score"], stock.analyse(Board(), limit, info = chess.engine.INFO_SCORE)["score"])
+                self.assertNotIn("pv", scores)
+            finally:
+                stock.quit()
+                lean.quit()
+
+
+# the first engine process started in a directory fails its first search as told by FAULT, the next ones work
+FAULTY_ENGINE = """#!{python}
+import os, sys, time
+starts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "starts")
+with open(starts, "a") as f:
+    f.write("x")
+first = os.path.getsize(starts) == 1
+for line in sys.stdin:
+    command = line.split()[0] if line.split() else ""
+    if command == "uci":
+        print("id name faulty")
+        print("uciok")
+    elif command == "isready":
+        print("readyok")
+    elif command == "go":
+        if first and "{fault}" == "hang":
+            time.sleep(60)
+        if first and "{fault}" == "die":
+            sys.exit(1)
+        print("info depth 1 score cp 10 nodes 10 pv e2e4")
+        print("bestmove e2e4")
+    elif command == "quit":
+        break
+    sys.stdout.flush()
+"""
+
+class TestSupervisor(unittest.TestCase):
+
+    def engine(self, dir: str, fault: str) -> SupervisedEngine:
+        path = os.path.join(dir, "faulty.py")
+        with open(path, "w") as f:
+            f.write(FAULTY_ENGINE.format(python = sys.executable, fault = fault))
+        os.chmod(path, 0o755)
+        return SupervisedEngine(path, {}, hang_factor = 1, hang_grace = 0.5, lean = True)
+
+    def test_hung_search(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            engine = self.engine(dir, "hang")
+            start = time.time()
+            info = engine.analyse(Board(), chess.engine.Limit(time = 0.1))
+            self.assertEqual(info["pv"], [Move.from_uci("e2e4")])
+            self.assertEqual(engine.restarts, 1)
+            self.assertLess(time.time() - start, 10)
+            engine.close()
+
+    def test_dead_engine(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            engine = self.engine(dir, "die")
+            self.assertEqual(engine.play(Board(), chess.engine.Limit(time = 0.1)).move, Move.from_uci("e2e4"))
+            self.assertEqual(engine.restarts, 1)
+            engine.close()
+
+    def test_watchdog(self) -> None:
+        watchdog = Watchdog()
+        fired: List[str] = []
+        watchdog.arm(0.05, lambda: fired.append("late"))
+        watchdog.disarm(watchdog.arm(0.05, lambda: fired.append("disarmed")))
+        watchdog.arm(60, lambda: fired.append("later"))
+        time.sleep(0.3)
+        self.assertEqual(fired, ["late"])
+
+
+class PairEngine:
+    """
+    answers two PVs from the first legal moves, once `release` is set
+    """
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.release.set()
+        self.started = threading.Event()
+        self.searched: List[str] = []
+        self.stops = 0
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, multipv: int = 1, **kwargs) -> List[chess.engine.InfoDict]:
+        self.started.set()
+        self.release.wait(5)
+        self.searched.append(board.fen())
+        moves = list(board.legal_moves)[:multipv]
+        return [{"pv": [move], "score": PovScore(Cp(100 - i), board.turn), "nps": 1000, "nodes": 1000} for i, move in enumerate(moves)]
+
+    def stop(self) -> None:
+        self.stops += 1
+        self.release.set()
+
+    def close(self) -> None:
+        pass
+
+
+class TestSpeculator(unittest.TestCase):
+
+    def test_hit(self) -> None:
+        speculator = Speculator(PairEngine()) # type: ignore
+        board = Board()
+        board.push_uci("e2e4")
+        speculator.speculate(board, chess.engine.Limit(nodes = 1))
+        info = speculator.take(board.copy())
+        self.assertIsNotNone(info)
+        self.assertEqual(len(info or []), 2)
+        self.assertEqual((speculator.hits, speculator.misses), (1, 0))
+        # taken once only
+        self.assertIsNone(speculator.take(board))
+        speculator.close()
+
+    def test_miss(self) -> None:
+        speculator = Speculator(PairEngine()) # type: ignore
+        predicted = Board()
+        predicted.push_uci("e2e4")
+        speculator.speculate(predicted, chess.engine.Limit(nodes = 1))
+        reached = Board()
+        reached.push_uci("d2d4")
+        self.assertIsNone(speculator.take(reached))
+        # a new prediction discards the pending one
+        speculator.speculate(reached, chess.engine.Limit(nodes = 1))
+        self.assertEqual(speculator.misses, 1)
+        self.assertIsNotNone(speculator.take(reached))
+        speculator.close()
+
+    def test_discard(self) -> None:
+        engine = PairEngine()
+        engine.release.clear()
+        speculator = Speculator(engine) # type: ignore
+        first, second = Board(), Board()
+        first.push_uci("e2e4")
+        second.push_uci("d2d4")
+        speculator.speculate(first, chess.engine.Limit(nodes = 1))
+        engine.started.wait(5)
+        speculator.speculate(second, chess.engine.Limit(nodes = 1))
+        speculator.discard()
+        self.assertIsNone(speculator.take(second))
+        self.assertEqual((speculator.hits, speculator.misses), (0, 2))
+        speculator.close()
+        # the search already running is stopped, the queued one never starts
+        self.assertEqual(engine.stops, 1)
+        self.assertEqual(engine.searched, [first.fen()])
+
+    def test_budgets(self) -> None:
+        engine = PairEngine()
+        engine.release.clear()
+        budgets = BudgetManager(Allowance(), Allowance(nodes = 100_000))
+        speculator = Speculator(engine, budgets) # type: ignore
+        budgets.start_game()
+        budgets.start_candidate()
+        first = budgets.candidate
+        speculator.speculate(Board(), chess.engine.Limit(nodes = 50_000))
+        engine.started.wait(5)
+        # the search ends during the next candidate
+        budgets.start_candidate()
+        engine.release.set()
+        speculator.close()
+        self.assertEqual((first.nodes if first else None, budgets.candidate.nodes if budgets.candidate else None), (1000, 0))
+        self.assertEqual(budgets.game.nodes, 1000)
+        # not started when the candidate can't cover it
+        speculator = Speculator(engine, budgets) # type: ignore
+        speculator.speculate(Board(), chess.engine.Limit(nodes = 200_000))
+        self.assertIsNone(speculator.take(Board()))
+        speculator.close()
+        self.assertEqual(len(engine.searched), 1)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_stop(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            profiler = Profiler(interval = 0.001, output_dir = dir)
+            profiler.start()
+            sampler = profiler.sampler
+            time.sleep(0.05)
+            profiler.stop()
+            assert sampler
+            self.assertFalse(sampler.is_alive())
+            samples = sum(profiler.stacks.values())
+            self.assertGreater(samples, 0)
+            with open(os.path.join(dir, os.listdir(dir)[0])) as f:
+                self.assertEqual(sum(int(line.split()[-1]) for line in f), samples)
+
+    def test_speculator_wait(self) -> None:
+        engine = PairEngine()
+        engine.release.clear()
+        speculator = Speculator(engine) # type: ignore
+        board = Board()
+        speculator.speculate(board, chess.engine.Limit(nodes = 1))
+        engine.started.wait(5)
+        taker = threading.Thread(target = speculator.take, args = (board,))
+        taker.start()
+        time.sleep(0.05)
+        # waiting on the speculator's pool thread, not running python
+        self.assertTrue(collapse(sys._current_frames()[taker.ident]).startswith("engine-wait;"))
+        engine.release.set()
+        taker.join()
+        speculator.close()
+
+
+class InlinePool:
+    """
+    multiprocessing.Pool running the jobs in the calling process
+    """
+
+    def __init__(self, processes: int, initializer = None, initargs = ()) -> None:
+        pass
+
+    def __enter__(self) -> "InlinePool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def imap_unordered(self, func, items, chunksize = 1):
+        return map(func, items)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_resume(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            for name in ["a", "b"]:
+                with open(os.path.join(dir, f"{name}.pgn"), "w") as f:
+                    f.write("x" * 100)
+            args = argparse.Namespace(input_glob = os.path.join(dir, "*.pgn"), parts = "3", workers = "2", ledger = os.path.join(dir, "ledger.tsv"), verbose = None)
+            ran: List[Tuple[str, int]] = []
+            interrupted = True
+            def run_job(job: batch.Job) -> batch.JobResult:
+                ran.append((os.path.basename(job.file), job.part))
+                # b.pgn 2/3 is interrupted in the first run, and not recorded as done
+                if interrupted and (os.path.basename(job.file), job.part) == ("b.pgn", 2):
+                    return batch.JobResult(job, 0, 0, 1, "interrupted")
+                return batch.JobResult(job, 10, 1, 1)
+            with mock.patch("workerpool.multiprocessing.Pool", InlinePool), mock.patch("batch.run_job", run_job):
+                batch.run_batch(args, 48)
+                self.assertEqual(len(ran), 6)
+                ran.clear()
+                interrupted = False
+                batch.run_batch(args, 48)
+                self.assertEqual(ran, [("b.pgn", 2)])
+                ran.clear()
+                batch.run_batch(args, 49)
+                self.assertEqual(len(ran), 6)
+            with open(args.ledger) as f:
+                self.assertEqual(len(f.readlines()), 5 + 1 + 6)
+
+
+class TestServer(unittest.TestCase):
+
+    def test_seen_positions(self) -> None:
+        node = Game().add_main_variation(Move.from_uci("e2e4"))
+        server = Server(logger, "http://localhost:9", "", 48)
+        with mock.patch("server.http.get", return_value = mock.Mock(status_code = 404)) as get:
+            # rejected positions are asked again, a higher tier may find a puzzle there
+            self.assertFalse(server.is_seen_pos(node))
+            self.assertFalse(server.is_seen_pos(node))
+            self.assertEqual(get.call_count, 2)
+        with mock.patch("server.http.get", return_value = mock.Mock(status_code = 200)) as get:
+            self.assertTrue(server.is_seen_pos(node))
+            self.assertTrue(server.is_seen_pos(node))
+            self.assertEqual(get.call_count, 1)
+
+    def test_posted_positions(self) -> None:
+        node = Game().add_main_variation(Move.from_uci("e2e4"))
+        server = Server(logger, "", "", 48)
+        self.assertFalse(server.is_seen_pos(node))
+        with mock.patch("builtins.print"):
+            server.post("ZlCTzfMG", Puzzle(node, [Move.from_uci("e7e5")], 100))
+        self.assertTrue(server.is_seen_pos(node))
+
+
+class TestMainline(unittest.TestCase):
+
+    def test_eval_encoding(self) -> None:
+        for score in [Cp(0), Cp(-250), Mate(3), Mate(-1), Mate(-0), MateGiven]:
+            pov = PovScore(score, WHITE)
+            self.assertEqual(decode_eval(encode_eval(pov)), pov)
+        self.assertEqual(decode_eval(encode_eval(PovScore(Cp(50000), BLACK))), PovScore(Cp(-30000), WHITE))
+        self.assertIsNone(decode_eval(encode_eval(None)))
+
+    def test_visitor(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            text = pgn.read()
+        game = chess.pgn.read_game(StringIO(text + "\n"))
+        mainline = parse_game(text.replace("1. e4", "1. e4 ( 1. d4 { [%eval 0.5] } )"))
+        assert mainline
+        self.assertEqual(mainline.moves, Mainline.from_game(game).moves)
+        self.assertEqual(mainline.evals, Mainline.from_game(game).evals)
+
+    def test_pack(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = chess.pgn.read_game(pgn)
+        mainline = Mainline.from_game(game)
+        self.assertEqual(mainline.game_id(), "ZlCTzfMG")
+        packed = mainline.pack()
+        unpacked, size = Mainline.unpack(memoryview(packed + b"trailing"))
+        self.assertEqual(size, len(packed))
+        self.assertEqual(unpacked, mainline)
+        node = unpacked.nodes().at(len(mainline.moves))
+        self.assertEqual(node.board(), game.end().board())
+
+
+    def test_illegal_move(self) -> None:
+        text = '[Site "https://lichess.org/ZlCTzfMG"]\n1. e4 { [%eval 0.3] } e5 2. Ke3 Nc6 *\n'
+        self.assertIsNone(parse_game(text))
+        parser = ParserPool(2)
+        parsed = list(parser.parse([(1, text), (2, text.replace("Ke3", "Ke2"))]))
+        parser.close()
+        self.assertIsNone(parsed[0][1])
+        self.assertEqual(len(parsed[1][1].moves), 4)
+
+    def test_parser_pool(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            fixture = pgn.read()
+        moves = "e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O".split()
+        texts = []
+        for i in range(50):
+            if i % 7 == 3:
+                texts.append(f'[Site "https://lichess.org/illegal{i}"]\n1. e4 e5 2. Ke3 *\n')
+            elif i % 2:
+                texts.append(fixture.replace("ZlCTzfMG", f"pool{i:04d}"))
+            else:
+                line = " ".join(f"{n // 2 + 1}. {m} {{ [%eval {n / 10}] }}" if n % 2 == 0 else f"{m} {{ [%eval {n / 10}] }}" for n, m in enumerate(moves[:i % 16 + 1]))
+                texts.append(f'[Site "https://lichess.org/short{i:03d}"]\n{line} *\n')
+        inline = list(ParserPool(0).parse(enumerate(texts)))
+        # small batches and few of them in flight, so that the pool has to wait and reorder
+        parser = ParserPool(3, batch_size = 4, in_flight = 2)
+        pooled = list(parser.parse(enumerate(texts)))
+        parser.close()
+        self.assertEqual([i for i, _ in pooled], list(range(len(texts))))
+        self.assertEqual(pooled, inline)
+        self.assertEqual(sum(mainline is None for _, mainline in pooled), 7)
+        self.assertEqual(pooled[5][1].game_id(), "pool0005")
+
+class TestBudget(unittest.TestCase):
+
+    def test_candidate_budget(self) -> None:
+        budgets = BudgetManager(Allowance(nodes = 1000), Allowance(time = 1))
+        budgets.start_game()
+        budgets.start_candidate()
+        budgets.charge(100, 2)
+        with self.assertRaises(BudgetExceeded) as e:
+            budgets.check()
+        self.assertEqual(e.exception.budget.scope, "candidate")
+        budgets.start_candidate()
+        budgets.check()
+        budgets.charge(900, 0)
+        with self.assertRaises(BudgetExceeded) as e:
+            budgets.check()
+        self.assertEqual(e.exception.budget.scope, "game")
+
+    def test_search_cut_short(self) -> None:
+        class WinningEngine:
+            """
+            black is winning, only by its first move
+            """
+            def __init__(self) -> None:
+                self.limits: List[chess.engine.Limit] = []
+            def analyse(self, board: Board, limit: chess.engine.Limit, multipv: int = 1, **kwargs) -> List[chess.engine.InfoDict]:
+                self.limits.append(limit)
+                moves = list(board.legal_moves)[:multipv]
+                return [{"pv": [move], "score": PovScore(Cp(800 - 800 * i), BLACK), "nodes": 20_000_000} for i, move in enumerate(moves)]
+            def close(self) -> None:
+                pass
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "verdicts.tsv")
+            stub = WinningEngine()
+            # covers a pair and a reply search, not the next pair one
+            budgets = BudgetManager(Allowance(), Allowance(nodes = 40_000_000))
+            server = Server(logger, "", "", 0)
+            generator = Generator(stub, server, budgets, verdicts = VerdictCache(path, 49)) # type: ignore
+            game = Game()
+            node = game.add_main_variation(Move.from_uci("e2e4"))
+            budgets.start_game()
+            with self.assertRaises(BudgetExceeded):
+                generator.probe_position(node, "advantage", Cp(0), Cp(500), 3)
+            self.assertEqual([limit.nodes for limit in stub.limits], [30_000_000, 15_000_000])
+            self.assertEqual(budgets.candidate.nodes if budgets.candidate else None, 40_000_000)
+            self.assertIsNone(VerdictCache(path, 49).get(VerdictCache.key(node.board(), Cp(0)), 3))
+            self.assertEqual(generator.rejections.by_reason()["out of budget"].count, 1)
+
+
+class TestRejections(unittest.TestCase):
+
+    def test_by_reason(self) -> None:
+        rejections = Rejections(logger)
+        rejections.record("one-mover", 1, 1000, 0.5)
+        rejections.record("one-mover", 3, 3000, 1.5)
+        rejections.record("no swing", 3)
+        reasons = rejections.by_reason()
+        self.assertEqual((reasons["one-mover"].count, reasons["one-mover"].nodes, reasons["one-mover"].time), (2, 4000, 2.0))
+        self.assertEqual(reasons["no swing"].count, 1)
+
+
+class TestLimits(unittest.TestCase):
+
+    def test_complexity(self) -> None:
+        self.assertEqual(complexity(Board("7k/8/6K1/8/8/8/8/Q7 b - - 0 1")), "forced")
+        self.assertEqual(complexity(Board("7k/8/6K1/8/8/8/8/Q7 w - - 0 1")), "endgame")
+        self.assertEqual(complexity(Board(), Mate(2)), "short mate")
+        self.assertEqual(complexity(Board()), "normal")
+
+    def test_policy(self) -> None:
+        board = Board("7k/8/6K1/8/8/8/8/Q7 b - - 0 1")
+        self.assertEqual(LimitPolicy.fixed().limit("pair", board, 0), LimitPolicy().limit("pair", Board(), 3))
+        self.assertEqual(LimitPolicy().limit("pair", board, 1).nodes, 30_000_000 * 0.25 * 0.75)
+        self.assertEqual(LimitPolicy.fixed().limit("reply", board, 0).nodes, 15_000_000)
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "limits.json")
+            policy = LimitPolicy()
+            policy.bases["reply"] = chess.engine.Limit(depth = 30, time = 5, nodes = 5_000_000)
+            policy.save(path, {})
+            self.assertEqual(LimitPolicy.load(path).limit("reply", Board(), 3), chess.engine.Limit(depth = 30, time = 5, nodes = 5_000_000))
+
+
+class TestNextPair(unittest.TestCase):
+
+    def test_limits_by_side(self) -> None:
+        class RecordingEngine:
+            def __init__(self) -> None:
+                self.searches: List[Tuple[Color, chess.engine.Limit, int]] = []
+            def analyse(self, board: Board, limit: chess.engine.Limit, multipv: int = 1, **kwargs) -> List[chess.engine.InfoDict]:
+                self.searches.append((board.turn, limit, multipv))
+                moves = list(board.legal_moves)[:multipv]
+                return [{"pv": [move], "score": PovScore(Cp(800 - 800 * i), BLACK)} for i, move in enumerate(moves)]
+            def close(self) -> None:
+                pass
+        engine = RecordingEngine()
+        generator = Generator(engine, Server(logger, "", "", 0)) # type: ignore
+        attack = Game().add_main_variation(Move.from_uci("e2e4"))
+        pair = generator.get_next_pair(attack, BLACK)
+        assert pair
+        defense = attack.add_main_variation(pair.best.move)
+        reply = generator.get_next_pair(defense, BLACK)
+        assert reply
+        self.assertIsNone(reply.second)
+        policy = LimitPolicy.fixed()
+        self.assertEqual(engine.searches, [
+            (BLACK, policy.limit("pair", attack.board(), 0), 2),
+            (WHITE, policy.limit("reply", defense.board(), 0), 1),
+        ])
+        self.assertLess(engine.searches[1][1].nodes, engine.searches[0][1].nodes)
+
+
+class TestVerdictCache(unittest.TestCase):
+
+    def test_persistence(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "verdicts.tsv")
+            key = VerdictCache.key(Board(), Cp(20))
+            VerdictCache(path, 48).record(key, Verdict(2, "two-mover", 1000))
+            VerdictCache(path, 48).record(VerdictCache.key(Board(), Cp(-300)), Verdict(2, "duplicate position", 0))
+            cache = VerdictCache(path, 48)
+            self.assertEqual(cache.get(key, 1), Verdict(2, "two-mover", 1000))
+            self.assertIsNone(cache.get(key, 3))
+            self.assertIsNone(cache.get(VerdictCache.key(Board(), Cp(-300)), 1))
+            self.assertIsNone(VerdictCache(path, 49).get(key, 1))
+
+    def test_run_context(self) -> None:
+        args = argparse.Namespace(game_time = None, game_nodes = None, candidate_time = None, candidate_nodes = None, syzygy = None, speculate = False)
+        self.assertEqual(verdict_context(args, "Stockfish 15", LimitPolicy.fixed()), "Stockfish 15 fixed")
+        args.candidate_nodes = "1000000"
+        args.syzygy = "syzygy"
+        self.assertEqual(verdict_context(args, "Stockfish 15", LimitPolicy.fixed()), "Stockfish 15 fixed budgets=-,-,-,1000000 syzygy")
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "verdicts.tsv")
+            key = VerdictCache.key(Board(), Cp(20))
+            # the same position reached through other moves may not repeat
+            VerdictCache(path, 49).record(key, Verdict(2, "repetition in solution", 1000))
+            self.assertIsNone(VerdictCache(path, 49).get(key, 1))
+
+    def test_context(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "verdicts.tsv")
+            key = VerdictCache.key(Board(), Cp(20))
+            fixed = f"Stockfish 15 {LimitPolicy.fixed().signature()}"
+            VerdictCache(path, 48, fixed).record(key, Verdict(2, "two-mover", 1000))
+            self.assertIsNotNone(VerdictCache(path, 48, fixed).get(key, 1))
+            # weaker searches, or another engine, may have missed the puzzle
+            self.assertIsNone(VerdictCache(path, 48, f"Stockfish 15 {LimitPolicy().signature()}").get(key, 1))
+            self.assertIsNone(VerdictCache(path, 48, f"Stockfish 16 {LimitPolicy.fixed().signature()}").get(key, 1))
+
+
+class StubProber:
+    """
+    probes in `delay` seconds, plies in `puzzles` give a puzzle
+    """
+
+    def __init__(self, puzzles: List[int], delay: float) -> None:
+        self.engine = BudgetedEngineStub(CancellableEngine(None)) # type: ignore
+        self.budgets = BudgetManager(Allowance(), Allowance())
+        self.puzzles = puzzles
+        self.delay = delay
+        self.probed: List[int] = []
+
+    def close_engines(self) -> None:
+        pass
+
+    def probe_position(self, node: GameNode, kind: str, prev_score: Score, score: Score, tier: int) -> Union[Puzzle, Score]:
+        time.sleep(self.delay * (10 - node.ply()))
+        self.engine.engine.check()
+        self.probed.append(node.ply())
+        return Puzzle(node, [], 0) if node.ply() in self.puzzles else score
+
+class BudgetedEngineStub:
+    def __init__(self, engine: CancellableEngine) -> None:
+        self.engine = engine
+
+    def close(self) -> None:
+        pass
+
+
+class TestProbePool(unittest.TestCase):
+
+    def test_earliest_puzzle(self) -> None:
+        game = Game()
+        node: GameNode = game
+        candidates = []
+        for ply, move in enumerate(["e2e4", "e7e5", "g1f3", "b8c6", "f1b5", "a7a6"], 1):
+            node = node.add_main_variation(Move.from_uci(move))
+            candidates.append(Candidate(ply, node, "advantage", Cp(0), Cp(300)))
+        probers = [StubProber([3, 4], 0.01) for _ in range(3)]
+        pool = ProbePool(probers) # type: ignore
+        # ply 4 is found first, but ply 3 is earlier
+        puzzle = pool.first_puzzle(candidates, 3)
+        self.assertEqual(puzzle.node.ply() if puzzle else None, 3)
+        pool.close()
+        self.assertNotIn(6, [ply for prober in probers for ply in prober.probed])
+
+
+# searches until told to stop
+ENDLESS_ENGINE = """#!{python}
+import sys
+for line in sys.stdin:
+    command = line.split()[0] if line.split() else ""
+    if command == "uci":
+        print("id name endless")
+        print("uciok")
+    elif command == "isready":
+        print("readyok")
+    elif command == "go":
+        print("info depth 1 score cp 10 nodes 10 pv e2e4")
+    elif command == "stop":
+        print("bestmove e2e4")
+    elif command == "quit":
+        break
+    sys.stdout.flush()
+"""
+
+class TestCancellableEngine(unittest.TestCase):
+
+    def test_stop(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "endless.py")
+            with open(path, "w") as f:
+                f.write(ENDLESS_ENGINE.format(python = sys.executable))
+            os.chmod(path, 0o755)
+            supervised = SupervisedEngine(path, {}, lean = True)
+            engine = CancellableEngine(supervised)
+            cancelled = threading.Event()
+            engine.cancelled = cancelled
+            raised: List[Exception] = []
+            def search() -> None:
+                try:
+                    engine.analyse(Board(), chess.engine.Limit(nodes = 10 ** 9))
+                except Exception as e:
+                    raised.append(e)
+            thread = threading.Thread(target = search)
+            thread.start()
+            time.sleep(0.2)
+            # another probe's cancellation leaves the search alone
+            engine.stop(threading.Event())
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+            cancelled.set()
+            engine.stop(cancelled)
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            self.assertIsInstance(raised[0], Cancelled)
+            supervised.close()
+
+
+class TestYieldModel(unittest.TestCase):
+
+    def test_train(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            mainline = Mainline.from_game(chess.pgn.read_game(pgn))
+        self.assertIn("tier=2", features(mainline, 2))
+        # only tier 3 games give puzzles
+        x = np.array([hashed(features(mainline, i % 4)) for i in range(400)])
+        y = np.array([1.0 if i % 4 == 3 else 0.0 for i in range(400)])
+        model = YieldModel.train(x, y)
+        self.assertGreater(model.score(mainline, 3), 0.5)
+        self.assertLess(model.score(mainline, 0), 0.5)
+
+
+class TestGameCache(unittest.TestCase):
+
+    def test_round_trip(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            mainline = Mainline.from_game(chess.pgn.read_game(pgn))
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, "games.pgc")
+            with open(file, "wb") as out:
+                out.write(MAGIC)
+                for tier in range(4):
+                    write_record(out, tier, mainline)
+            cached = list(GameCache(file, part = 1, parts = 2))
+        self.assertEqual([(games, tier) for (games, tier), _ in cached], [(2, 1), (4, 3)])
+        self.assertEqual(cached[0][1].moves, mainline.moves)
+        self.assertEqual(cached[0][1].evals, mainline.evals)
+        self.assertEqual(cached[0][1].game_id(), "ZlCTzfMG")
+
+    def test_annotate(self) -> None:
+        class ScoreEngine:
+            def __init__(self) -> None:
+                self.games: List[object] = []
+            def analyse(self, board: Board, limit: chess.engine.Limit, game: object = None, **kwargs) -> chess.engine.InfoDict:
+                self.games.append(game)
+                return {"score": PovScore(Cp(50), board.turn)}
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            mainline = Mainline.from_game(chess.pgn.read_game(pgn))
+        known = mainline.evals[0]
+        for ply in range(1, len(mainline.evals)):
+            mainline.evals[ply] = -32768
+        engine = ScoreEngine()
+        analysed = annotate_game(engine, mainline, chess.engine.Limit(nodes = 1000)) # type: ignore
+        self.assertEqual(analysed, len(mainline.moves) - 1)
+        self.assertEqual(mainline.evals[0], known)
+        # after white's second move, black is to move
+        self.assertEqual(mainline.evals[2], -50)
+        self.assertEqual(set(engine.games), {"ZlCTzfMG"})
+
+
+class TestDumpIndex(unittest.TestCase):
+
+    def test_frames(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = pgn.read().rstrip("\n") + "\n\n\n"
+        games = [game.replace("ZlCTzfMG", f"game{i:04}") for i in range(20)]
+        data = "".join(games).encode()
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, "games.pgn.zst")
+            # frames cut in the middle of games
+            with open(file, "wb") as out:
+                for start in range(0, len(data), 5000):
+                    out.write(zstandard.ZstdCompressor().compress(data[start:start + 5000]))
+            self.assertEqual(build_index(file, index_path(file)), 20)
+            index = DumpIndex(file)
+            self.assertEqual("".join(index.lines("game0013") or []), games[13])
+            self.assertEqual("".join(index.lines("game0019") or []), games[19])
+            self.assertIsNone(index.lines("ZlCTzfMG"))
+            index.close()
+
+    def test_one_pass(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = pgn.read().rstrip("\n") + "\n\n\n"
+        games = [game.replace("ZlCTzfMG", f"game{i:04}") for i in range(20)]
+        with tempfile.TemporaryDirectory() as dir:
+            # a single frame, like the lichess dumps
+            file = os.path.join(dir, "games.pgn.zst")
+            with open(file, "wb") as out:
+                out.write(zstandard.ZstdCompressor().compress("".join(games).encode()))
+            build_index(file, index_path(file))
+            index = DumpIndex(file)
+            wanted = ["game0017", "game0002", "nothere1", "game0003", "game0011", "game0002"]
+            with mock.patch("dumpindex.zstandard.ZstdDecompressor", wraps = zstandard.ZstdDecompressor) as decompressor:
+                found = list(index.games(wanted))
+            self.assertEqual(decompressor.call_count, 1)
+            self.assertEqual([game_id for game_id, _ in found], ["nothere1", "game0002", "game0002", "game0003", "game0011", "game0017"])
+            for game_id, lines in found[1:]:
+                self.assertEqual("".join(lines or []), games[int(game_id[4:])])
+            index.close()
+
+    def test_sorted_runs(self) -> None:
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            game = pgn.read().rstrip("\n") + "\n\n\n"
+        # out of order, with a duplicate id
+        ids = [f"game{(i * 7) % 20:04}" for i in range(20)] + ["game0003"]
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, "games.pgn")
+            with open(file, "w") as out:
+                out.write("".join(game.replace("ZlCTzfMG", id) for id in ids))
+            self.assertEqual(build_index(file, os.path.join(dir, "whole.idx")), 21)
+            with mock.patch("dumpindex.RUN", 3):
+                self.assertEqual(build_index(file, index_path(file)), 21)
+            with open(os.path.join(dir, "whole.idx"), "rb") as whole, open(index_path(file), "rb") as merged:
+                self.assertEqual(merged.read(), whole.read())
+            self.assertEqual(sorted(os.listdir(dir)), ["games.pgn", "games.pgn.idx", "whole.idx"])
+            index = DumpIndex(file)
+            self.assertEqual([id.decode() for id in index.table["id"]], sorted(ids))
+            # the first of the duplicates
+            self.assertEqual(index.find("game0003"), (0, ids.index("game0003") * len(game.encode())))
+            index.close()
+
+
+class ScriptedTables:
+    """
+    chess.syzygy tables answering (wdl, dtz) from a script keyed by position, a draw otherwise
+    """
+
+    def __init__(self, script: Dict[str, Tuple[int, int]], missing: Set[str] = set()) -> None:
+        self.script = script
+        self.missing = missing
+
+    def get_wdl(self, board: Board) -> Optional[int]:
+        return None if board.epd() in self.missing else self.script.get(board.epd(), (0, 0))[0]
+
+    def get_dtz(self, board: Board) -> Optional[int]:
+        return None if board.epd() in self.missing else self.script.get(board.epd(), (0, 0))[1]
+
+    def close(self) -> None:
+        pass
+
+
+class TestTablebaseProbes(unittest.TestCase):
+
+    def tablebase(self, script: Dict[str, Tuple[int, int]], missing: Set[str] = set()) -> Tablebase:
+        with mock.patch("chess.syzygy.open_tablebase", return_value = ScriptedTables(script, missing)):
+            return Tablebase("syzygy")
+
+    def after(self, fen: str, *moves: str) -> str:
+        board = Board(fen)
+        for move in moves:
+            board.push_uci(move)
+        return board.epd()
+
+    def test_win_fast(self) -> None:
+        fen = "7k/8/6K1/8/8/8/8/Q7 w - - 0 1"
+        tablebase = self.tablebase({
+            # probed with the loser to move
+            self.after(fen, "a1a7"): (-2, -3),
+            self.after(fen, "a1b1"): (-2, -9),
+            self.after(fen, "a1a7", "h8g8"): (2, 1),
+        })
+        ranked = tablebase.rank_moves(Board(fen))
+        assert ranked
+        # Qa8# and Qg7#, then the shortest win
+        self.assertEqual(sorted(move.uci() for _, move in ranked[:2]), ["a1a8", "a1g7"])
+        self.assertEqual([move.uci() for _, move in ranked[2:4]], ["a1a7", "a1b1"])
+        self.assertEqual([key for key, _ in ranked[:5]], [(3, 0), (3, 0), (2, -3), (2, -9), (0, 0)])
+        pair = tablebase.next_move_pair(Game.from_board(Board(fen)), WHITE)
+        assert pair
+        self.assertEqual(pair.best.score, Mate(1))
+        # a7 g8 g7#, followed along the tables
+        self.assertEqual(tablebase.score(Board(fen), ranked[2]), Mate(2))
+        tablebase.mate_plies = 1
+        self.assertEqual(tablebase.score(Board(fen), ranked[2]), TB_WIN)
+
+    def test_lose_slowly(self) -> None:
+        fen = "8/8/8/8/8/2k5/8/K1Q5 b - - 0 1"
+        board = Board(fen)
+        script = {self.after(fen, move.uci()): (2, 5 + i) for i, move in enumerate(board.legal_moves)}
+        tablebase = self.tablebase(script)
+        slowest = max(script, key = lambda epd: script[epd][1])
+        best = tablebase.best_move(board)
+        assert best
+        self.assertEqual(self.after(fen, best.uci()), slowest)
+        pair = tablebase.next_move_pair(Game.from_board(board), WHITE)
+        assert pair
+        self.assertEqual(pair.best.score, TB_WIN)
+
+    def test_missing_table(self) -> None:
+        fen = "7k/8/6K1/8/8/8/8/Q7 w - - 0 1"
+        tablebase = self.tablebase({}, {self.after(fen, "g6f6")})
+        self.assertIsNone(tablebase.rank_moves(Board(fen)))
+        self.assertIsNone(tablebase.next_move_pair(Game.from_board(Board(fen)), WHITE))
+        self.assertIsNone(tablebase.best_move(Board(fen)))
+
+
+# 3-4 piece Syzygy tables, e.g. KQvK and KRvK
+syzygy_path = os.environ.get("SYZYGY_PATH", "syzygy")
+
+@unittest.skipUnless(os.path.isdir(syzygy_path), "no syzygy tables")
+class TestTablebase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tablebase = Tablebase(syzygy_path)
+
+    def test_mate_in_one(self) -> None:
+        game = Game.from_board(Board("7k/8/6K1/8/8/8/8/Q7 w - - 0 1"))
+        pair = self.tablebase.next_move_pair(game, WHITE)
+        assert pair
+        self.assertEqual(pair.best.move, Move.from_uci("a1a8"))
+        self.assertEqual(pair.best.score, Mate(1))
+
+    def test_defense(self) -> None:
+        # taking the undefended queen draws
+        board = Board("8/8/8/8/8/8/1Q6/k6K b - - 0 1")
+        self.assertEqual(self.tablebase.best_move(board), Move.from_uci("a1b2"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tablebase.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+import argparse
+import json
+import logging
+import math
+import time
+import workerpool
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+from budget import Allowance, BudgetManager
+from generator import Generator, DumpReader, adjusted_tier, make_engine, version, logger as generator_logger
+from limits import make_policy
+from mainline import Mainline, parse_game
+from server import Server
+from workerpool import worker_pool
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+@dataclass
+class Layout:
+    engines: int
+    threads: int
+    hash: int
+
+    def cpus(self) -> int:
+        return self.engines * self.threads
+
+@dataclass
+class Measure:
+    layout: Layout
+    puzzles: int
+    nodes: int
+    seconds: float
+
+    def puzzles_per_cpu_hour(self) -> float:
+        return self.puzzles / (self.layout.cpus() * self.seconds / 3600) if self.seconds else 0
+
+    def error(self) -> float:
+        """
+        standard error of puzzles_per_cpu_hour, puzzles being rare events: a count of n is known to about sqrt(n), and at least 1
+        """
+        return math.sqrt(max(self.puzzles, 1)) / (self.layout.cpus() * self.seconds / 3600) if self.seconds else 0
+
+    def rank(self) -> Tuple[float, float]:
+        # engine speed breaks ties, samples too small to produce puzzles still pick a sensible layout
+        return (self.puzzles_per_cpu_hour(), self.knps() / self.layout.cpus())
+
+    def knps(self) -> int:
+        return round(self.nodes / self.seconds / 1000) if self.seconds else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='tune.py',
+        description='finds the engine layout producing the most puzzles per CPU hour on this host')
+    parser.add_argument("--file", "-f", help="sample PGN file", required=True, metavar="FILE.pgn")
+    parser.add_argument("--sample", help="how many games with evals to use from the sample file, layouts closer than the noise of the puzzle counts are not told apart", default="2000")
+    parser.add_argument("--engine", "-e", help="analysis engine", default="./stockfish")
+    parser.add_argument("--layouts", help="comma separated ENGINESxTHREADS layouts", default="8x1,4x2,2x4,1x8")
+    parser.add_argument("--hash", help="comma separated hash sizes in MB to try with each layout", default="64,256")
+    parser.add_argument("--limits", help="engine search limits to measure with, as generator.py --limits", default="fixed", metavar="fixed|adaptive|LIMITS.json")
+    parser.add_argument("--output", "-o", help="where to write the best layout", default="layout.json")
+    parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
+    return parser.parse_args()
+
+
+def read_sample(file: str, size: int) -> List[Tuple[int, Mainline]]:
+    sample = []
+    for (_, tier), text in DumpReader(file, 1, 1):
+        mainline = parse_game(text)
+        if mainline:
+            sample.append((adjusted_tier(tier, len(mainline.moves)), mainline))
+        if len(sample) >= size:
+            break
+    return sample
+
+
+def make_worker(executable: str, layout: Layout, limits: str) -> Tuple[Generator, BudgetManager]:
+    generator_logger.setLevel(logging.WARNING)
+    engine = make_engine(executable, layout.threads, layout.hash)
+    # unlimited budgets, only used to count the nodes searched
+    budgets = BudgetManager(Allowance(), Allowance())
+    return (Generator(engine, Server(generator_logger, "", "", version), budgets, limits = make_policy(limits)), budgets)
+
+def run_games(games: List[Tuple[int, Mainline]]) -> Tuple[int, int]:
+    assert workerpool.worker
+    generator, budgets = workerpool.worker
+    puzzles = 0
+    for tier, mainline in games:
+        try:
+            if generator.analyze_game(mainline, tier):
+                puzzles += 1
+        except Exception as e:
+            logger.error("Exception on {}: {}".format(mainline.game_id(), e))
+    return puzzles, budgets.total.nodes
+
+
+def measure(executable: str, layout: Layout, sample: List[Tuple[int, Mainline]], limits: str = "fixed") -> Measure:
+    shards = [sample[i::layout.engines] for i in range(layout.engines)]
+    with worker_pool(layout.engines, make_worker, executable, layout, limits) as pool:
+        start = time.time()
+        results = pool.map(run_games, shards, chunksize = 1)
+        seconds = time.time() - start
+    return Measure(layout, sum(p for p, _ in results), sum(n for _, n in results), seconds)
+
+
+def main() -> None:
+    args = parse_args()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    sample = read_sample(args.file, int(args.sample))
+    logger.info(f"Tuning on {len(sample)} games from {args.file}")
+    layouts = [
+        Layout(int(engines), int(threads), int(hash))
+        for engines, threads in (l.split("x") for l in args.layouts.split(","))
+        for hash in args.hash.split(",")
+    ]
+    measures: List[Measure] = []
+    for layout in layouts:
+        m = measure(args.engine, layout, sample, args.limits)
+        logger.info(
+            f"{layout.engines} engines x {layout.threads} threads, hash {layout.hash}: "
+            f"{m.puzzles} puzzles in {round(m.seconds)}s, {m.knps()} knps, "
+            f"{round(m.puzzles_per_cpu_hour(), 1)} ± {round(m.error(), 1)} puzzles per CPU hour"
+        )
+        measures.append(m)
+    ranking = sorted(measures, key = lambda m: m.rank(), reverse = True)
+    best = ranking[0] if ranking else None
+    for m in ranking[1:]:
+        if best and best.puzzles_per_cpu_hour() - best.error() <= m.puzzles_per_cpu_hour() + m.error():
+            logger.warning(f"{m.layout} is within the noise of the best layout, a bigger --sample would tell them apart")
+    if best:
+        with open(args.output, "w") as f:
+            json.dump({
+                "engines": best.layout.engines,
+                "threads": best.layout.threads,
+                "hash": best.layout.hash,
+                "puzzles_per_cpu_hour": round(best.puzzles_per_cpu_hour(), 2),
+                "puzzles_per_cpu_hour_error": round(best.error(), 2),
+                "generator_version": version,
+            }, f, indent = 2)
+        logger.info(f"Best layout written to {args.output}: {best.layout}")
+
+
+if __name__ == "__main__":
+    main()
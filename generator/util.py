@@ -2,13 +2,17 @@ from dataclasses import dataclass
 import math
 import chess
 import chess.engine
+import chess.polyglot
 from model import EngineMove, NextMovePair
 from chess import Color, Board
-from chess.pgn import GameNode
-from chess.engine import SimpleEngine, Score
-from typing import Optional
+from chess.pgn import GameNode, ChildNode
+from chess.engine import Score
+from supervisor import Engine
+from collections import deque
+from typing import Deque, List, Optional
 
-nps = []
+# recent engine speeds in knps
+nps: Deque[float] = deque(maxlen = 10000)
 
 def material_count(board: Board, side: Color) -> int:
     values = { chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9 }
@@ -27,18 +31,35 @@ def maximum_castling_rights(board: chess.Board) -> chess.Bitboard:
     )
 
 
-def get_next_move_pair(engine: SimpleEngine, node: GameNode, winner: Color, limit: chess.engine.Limit) -> NextMovePair:
-    info = engine.analyse(node.board(), multipv = 2, limit = limit)
-    global nps
-    nps.append(info[0]["nps"] / 1000)
-    nps = nps[-10000:]
+def encode_move(move: chess.Move) -> int:
+    """16 bits: from square, to square, promotion piece type"""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def decode_move(code: int) -> chess.Move:
+    return chess.Move(code & 63, code >> 6 & 63, (code >> 12) or None)
+
+def position_key(node: ChildNode) -> int:
+    """64-bit key of the position before `node.move`, combined with that move"""
+    mixed = (encode_move(node.move) + 1) * 0x9E3779B97F4A7C15
+    return (chess.polyglot.zobrist_hash(node.parent.board()) ^ mixed) & 0xFFFFFFFFFFFFFFFF
+
+
+def get_next_move_pair(engine: Engine, node: GameNode, winner: Color, limit: chess.engine.Limit, multipv: int = 2) -> NextMovePair:
+    return pair_from_info(node, winner, analyse_pair(engine, node.board(), limit, multipv))
+
+def analyse_pair(engine: Engine, board: Board, limit: chess.engine.Limit, multipv: int = 2) -> List[chess.engine.InfoDict]:
+    info = engine.analyse(board, multipv = multipv, limit = limit)
+    nps.append(info[0].get("nps", 0) / 1000)
+    return info
+
+def pair_from_info(node: GameNode, winner: Color, info: List[chess.engine.InfoDict]) -> NextMovePair:
     # print(info)
-    best = EngineMove(info[0]["pv"][0], info[0]["score"].pov(winner))
+    pv = info[0]["pv"]
+    best = EngineMove(pv[0], info[0]["score"].pov(winner))
     second = EngineMove(info[1]["pv"][0], info[1]["score"].pov(winner)) if len(info) > 1 else None
-    return NextMovePair(node, winner, best, second)
+    return NextMovePair(node, winner, best, second, pv[1] if len(pv) > 1 else None)
 
 def avg_knps():
-    global nps
     return round(sum(nps) / len(nps)) if nps else 0
 
 def win_chances(score: Score) -> float:
@@ -0,0 +1,55 @@
+import os
+from dataclasses import dataclass
+from chess import Board
+from chess.engine import Score
+from chess.polyglot import zobrist_hash
+from typing import Dict, Optional, Tuple
+from util import win_chances
+
+# rejections that depend on something else than the position and the engine,
+# like a repetition of the moves of the game leading to it
+UNCACHED = {"puzzle", "duplicate position", "out of budget", "cancelled", "error", "repetition in solution"}
+
+VerdictKey = Tuple[int, int]
+
+@dataclass
+class Verdict:
+    tier: int
+    reason: str
+    nodes: int
+
+class VerdictCache:
+    """
+    Append-only record of probed positions that gave no puzzle, one tab separated line each:
+    version, search context, position hash, previous score bucket, tier, reason, nodes.
+    The search context names the engine, the limit policy, budgets, tablebases and speculation:
+    a verdict only holds for searches as strong as the ones that gave it, with the same settings,
+    in games of the same or a lower tier, as those are searched less and filtered harder.
+    """
+
+    def __init__(self, path: str, version: int, context: str = "") -> None:
+        self.path = path
+        self.version = version
+        self.context = context.replace("\t", " ")
+        self.verdicts: Dict[VerdictKey, Verdict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) >= 7 and fields[0] == str(version) and fields[1] == self.context:
+                        self.verdicts[(int(fields[2], 16), int(fields[3]))] = Verdict(int(fields[4]), fields[5], int(fields[6]))
+
+    @staticmethod
+    def key(board: Board, prev_score: Score) -> VerdictKey:
+        return (zobrist_hash(board), round(win_chances(prev_score) * 10))
+
+    def get(self, key: VerdictKey, tier: int) -> Optional[Verdict]:
+        verdict = self.verdicts.get(key)
+        return verdict if verdict and tier <= verdict.tier else None
+
+    def record(self, key: VerdictKey, verdict: Verdict) -> None:
+        if verdict.reason in UNCACHED:
+            return
+        with open(self.path, "a") as f:
+            f.write(f"{self.version}\t{self.context}\t{key[0]:016x}\t{key[1]}\t{verdict.tier}\t{verdict.reason}\t{verdict.nodes}\n")
+        self.verdicts[key] = verdict
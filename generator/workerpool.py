@@ -0,0 +1,22 @@
+"""
+Process pools whose workers build their engines once, when the worker process starts,
+and keep them for every task they run, instead of paying an engine start per task.
+Shared by the generator and the regenerator: regenerator/workerpool.py links to this file.
+"""
+import multiprocessing
+import multiprocessing.pool
+from typing import Any, Callable
+
+# what `build` returned in this worker process, None outside of pool workers
+worker: Any = None
+
+def init_worker(build: Callable[..., Any], *args: Any) -> None:
+    global worker
+    worker = build(*args)
+
+def worker_pool(processes: int, build: Callable[..., Any], *args: Any) -> multiprocessing.pool.Pool:
+    """
+    a pool whose tasks find `build(*args)` in `workerpool.worker`. `build` and `args` are pickled
+    to the workers, `build` has to be a module level function
+    """
+    return multiprocessing.Pool(processes, initializer = init_worker, initargs = (build, *args))
@@ -0,0 +1,156 @@
+"""
+Predicts from cheap features of a game whether it will give a puzzle, so that the generator
+can skip the games least likely to (--yield-model, --min-yield-score).
+
+Logistic regression over hashed features: the tier, the ply count and the shape of the eval trace.
+Trained on a dump or game cache, games whose id appears in a puzzle CSV (GameUrl column,
+like lichess_db_puzzle.csv) being the positives:
+
+    python3 yieldmodel.py -f 2022-08.pgc --puzzles lichess_db_puzzle.csv -o yield.npz
+"""
+import argparse
+import csv
+import logging
+import zlib
+import numpy as np
+from typing import Iterator, List, Set, Tuple
+from mainline import Mainline, MATE_THRESHOLD, MAX_CP, NO_EVAL
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
+
+DIMENSIONS = 1 << 16
+SWING = 0.3 # change of win chances counted as a swing
+
+def win_chances(evals: np.ndarray) -> np.ndarray:
+    """
+    vectorized util.win_chances of int16 encoded evals
+    """
+    cp = np.clip(evals.astype(np.float64), -MAX_CP, MAX_CP)
+    chances = 2 / (1 + np.exp(-0.00368208 * cp)) - 1
+    chances[evals > MATE_THRESHOLD] = 1
+    chances[evals < -MATE_THRESHOLD] = -1
+    return chances
+
+def features(mainline: Mainline, tier: int) -> List[str]:
+    evals = np.frombuffer(mainline.evals, dtype = np.int16)
+    evals = evals[evals != NO_EVAL]
+    plies = len(mainline.moves)
+    chances = win_chances(evals) if len(evals) else np.zeros(1)
+    swings = np.abs(np.diff(chances)) if len(chances) > 1 else np.zeros(1)
+    nb_swings = min(int((swings > SWING).sum()), 10)
+    mates = int((np.abs(evals) > MATE_THRESHOLD).sum())
+    return [
+        "bias",
+        f"tier={tier}",
+        f"plies={min(plies // 10, 20)}",
+        f"max_swing={int(swings.max() * 10)}",
+        f"swings={nb_swings}",
+        f"tier={tier},swings={nb_swings}",
+        f"mates={min(mates, 5)}",
+        f"max_advantage={int(np.abs(chances).max() * 10)}",
+        f"final={int(chances[-1] * 5)}",
+        f"evals={len(evals) * 10 // max(plies, 1)}",
+    ]
+
+def hashed(features: List[str]) -> List[int]:
+    return [zlib.crc32(f.encode()) % DIMENSIONS for f in features]
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    return 1 / (1 + np.exp(-x))
+
+
+class YieldModel:
+
+    def __init__(self, weights: np.ndarray) -> None:
+        self.weights = weights
+
+    def score(self, mainline: Mainline, tier: int) -> float:
+        """
+        from 0 to 1, how likely the game is to give a puzzle.
+        Classes are balanced in training, so 0.5 is an average game rather than a coin flip.
+        """
+        return float(sigmoid(self.weights[hashed(features(mainline, tier))].sum()))
+
+    @staticmethod
+    def load(path: str) -> "YieldModel":
+        return YieldModel(np.load(path)["weights"])
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, weights = self.weights)
+
+    @staticmethod
+    def train(x: np.ndarray, y: np.ndarray, epochs: int = 200, rate: float = 0.5, l2: float = 1e-4) -> "YieldModel":
+        """
+        x: hashed features of each game, one row per game, y: 1 for games that gave a puzzle
+        """
+        weights = np.zeros(DIMENSIONS)
+        # rare puzzles weigh as much as the many empty games
+        positive = max(y.mean(), 1e-6)
+        sample_weights = np.where(y == 1, 0.5 / positive, 0.5 / max(1 - positive, 1e-6))
+        for _ in range(epochs):
+            error = (sigmoid(weights[x].sum(axis = 1)) - y) * sample_weights
+            gradient = np.zeros(DIMENSIONS)
+            np.add.at(gradient, x, np.repeat(error[:, None], x.shape[1], axis = 1))
+            weights -= rate * (gradient / len(y) + l2 * weights)
+        return YieldModel(weights)
+
+
+def read_puzzle_games(path: str) -> Set[str]:
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        return {row["GameUrl"].split("/")[3][:8] for row in reader if row.get("GameUrl")}
+
+def read_games(file: str, size: int) -> Iterator[Tuple[int, Mainline]]:
+    from generator import DumpReader, adjusted_tier
+    from gamecache import GameCache, is_game_cache
+    from parsing import ParserPool
+    read = 0
+    games = iter(GameCache(file)) if is_game_cache(file) else ParserPool(0).parse(DumpReader(file, 1, 1))
+    for (_, tier), mainline in games:
+        if not mainline:
+            continue
+        yield adjusted_tier(tier, len(mainline.moves)), mainline
+        read += 1
+        if read >= size:
+            break
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='yieldmodel.py',
+        description='trains the model predicting which games give puzzles')
+    parser.add_argument("--file", "-f", help="PGN dump or game cache to learn from", required=True, metavar="FILE.pgn")
+    parser.add_argument("--puzzles", help="CSV of puzzles with a GameUrl column", required=True, metavar="PUZZLES.csv")
+    parser.add_argument("--games", help="how many games to learn from", default="200000")
+    parser.add_argument("--epochs", help="gradient descent iterations", default="200")
+    parser.add_argument("--output", "-o", help="where to write the model", default="yield.npz")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    logger.setLevel(logging.INFO)
+    puzzle_games = read_puzzle_games(args.puzzles)
+    rows, labels = [], []
+    for tier, mainline in read_games(args.file, int(args.games)):
+        rows.append(hashed(features(mainline, tier)))
+        labels.append(1.0 if mainline.game_id() in puzzle_games else 0.0)
+    x, y = np.array(rows), np.array(labels)
+    logger.info(f"{len(y)} games, {int(y.sum())} with puzzles")
+    # the last fifth of the games measures what a threshold costs
+    split = len(y) * 4 // 5
+    model = YieldModel.train(x[:split], y[:split], int(args.epochs))
+    scores = sigmoid(model.weights[x[split:]].sum(axis = 1))
+    held = y[split:]
+    for threshold in [0.1, 0.2, 0.3, 0.4, 0.5, 0.6]:
+        kept = scores >= threshold
+        recall = held[kept].sum() / max(held.sum(), 1)
+        logger.info(f"--min-yield-score {threshold}: skips {round(100 * (1 - kept.mean()))}% of games, keeps {round(100 * recall)}% of puzzles")
+    YieldModel.train(x, y, int(args.epochs)).save(args.output)
+    logger.info(f"Model written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
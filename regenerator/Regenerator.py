@@ -7,16 +7,19 @@ import chess
 import chess.pgn
 import chess.engine
 import copy
+import queue
 import sys
 import util
 import zstandard
-from model import Puzzle, NextMovePair
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from model import Puzzle, NextMovePair, Variant
 from io import StringIO
 from chess import Move, Color
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess.pgn import Game, ChildNode, GameNode
-from typing import List, Optional, Union, Set
-from util import get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances, count_mates
+from typing import Dict, Iterator, List, Optional, Union, Set, Tuple
+from chess.polyglot import zobrist_hash
+from util import get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances, count_mates, influence, replays
 
 version = 48
 
@@ -26,12 +29,29 @@ logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%
 
 pair_limit = chess.engine.Limit(depth=50, time=30, nodes=30_000_000)
 mate_defense_limit = chess.engine.Limit(depth=15, time=10, nodes=10_000_000)
+# quick look before the full search, most variants already play another move there
+shallow_limit = chess.engine.Limit(depth=12, time=1, nodes=500_000)
+# win chances the shallow best move must have over the expected one to abandon the variant
+divergence_margin = 0.3
 
 mate_soon = Mate(15)
 
 class Regenerator:
-    def __init__(self, engine: SimpleEngine):
+    def __init__(self, engine: SimpleEngine, helpers: Optional[List[SimpleEngine]] = None):
         self.engine = engine
+        # regenerators of the other engines of the pool, evaluating variants alongside this one
+        self.helpers = [Regenerator(helper) for helper in helpers or []]
+        self.idle: "queue.Queue[Regenerator]" = queue.Queue()
+        for regenerator in [self] + self.helpers:
+            self.idle.put(regenerator)
+        self.executor = ThreadPoolExecutor(1 + len(self.helpers), thread_name_prefix = "variant") if self.helpers else None
+        # seconds spent on each variant of the last puzzle
+        self.timings: List[Tuple[Variant, float]] = []
+        # positions of the variants already evaluated, the same one often comes from several puzzles
+        self.seen_variants: Set[int] = set()
+        self.max_seen_variants = 1_000_000
+        # if set, only the most relevant variants of each puzzle get an engine
+        self.max_variants: Optional[int] = None
 
     def is_valid_mate_in_one(self, pair: NextMovePair) -> bool:
         if pair.best.score != Mate(1):
@@ -98,6 +118,23 @@ class Regenerator:
 
         return [move] + follow_up
 
+    def diverges(self, board: chess.Board, expected: Move) -> bool:
+        """
+        whether a shallow search clearly prefers another move than the expected one of the original solution,
+        which is then scored on its own as a root move
+        """
+        if not board.is_legal(expected):
+            return True
+        info = self.engine.analyse(board, shallow_limit)
+        if not info.get("pv") or info["pv"][0] == expected:
+            return False
+        hint = self.engine.analyse(board, shallow_limit, root_moves=[expected])
+        if "score" not in hint:
+            return False
+        best_chances = win_chances(info["score"].pov(board.turn))
+        expected_chances = win_chances(hint["score"].pov(board.turn))
+        return best_chances > expected_chances + divergence_margin
+
     def cook_advantage(self, node: ChildNode, winner: Color, moves: [Move], compare_pos: int) -> Optional[List[NextMovePair]]:
 
         board = node.board()
@@ -108,6 +145,10 @@ class Regenerator:
             logger.debug("Found repetition, canceling")
             return None
 
+        if self.diverges(board, moves[compare_pos]):
+            logger.debug("Shallow search diverges from {}, aborting".format(moves[compare_pos]))
+            return None
+
         pair = self.get_next_pair(node, winner)
         if not pair:
             return []
@@ -124,20 +165,47 @@ class Regenerator:
 
         return [pair] + follow_up
 
-    def generate_new_puzzle(self, puzzle: Puzzle) -> Union[List[Puzzle], None]:
-        # create list of potentially removable pieces
-        # try removing each piece
-        # test each piece with analyze_position
-        # compare main lines with the resultant puzzles, if equal, add to the list
-        # return the list
-        puzzles = []
+    def variants(self, puzzle: Puzzle) -> List[Variant]:
+        """
+        the variants worth an engine search, most relevant first: the removed piece must have
+        an influence on the squares of the solution, the solution must still be legal,
+        and positions already evaluated are skipped
+        """
+        board = puzzle.node.board()
+        ranked = []
+        for variant in self.candidate_variants(puzzle):
+            new_board = board.copy(stack = False)
+            new_board.remove_piece_at(variant.square)
+            if not replays(new_board, puzzle.moves):
+                logger.debug("Solution illegal without {}".format(chess.SQUARE_NAMES[variant.square]))
+                continue
+            relevance = influence(board, variant.square, puzzle.moves)
+            if relevance == 0:
+                logger.debug("No influence from {}".format(chess.SQUARE_NAMES[variant.square]))
+                continue
+            key = zobrist_hash(variant.node.board())
+            if key in self.seen_variants:
+                logger.debug("Variant without {} already evaluated".format(chess.SQUARE_NAMES[variant.square]))
+                continue
+            ranked.append((relevance, key, variant))
+        ranked.sort(key = lambda r: -r[0])
+        # only the variants evaluated now are seen, the ones cut may come back with another puzzle
+        ranked = ranked[:self.max_variants]
+        if len(self.seen_variants) > self.max_seen_variants:
+            self.seen_variants.clear()
+        self.seen_variants.update(key for _, key, _ in ranked)
+        return [variant for _, _, variant in ranked]
+
+    def candidate_variants(self, puzzle: Puzzle) -> Iterator[Variant]:
+        """
+        the positions of the puzzle with one piece less, where the first move is still legal
+        and the side to move is in check only if it was in the original
+        """
         current_board = puzzle.node.board()
-        dict_of_pieces = current_board.piece_map(mask=chess.BB_ALL)
+        dict_of_pieces = current_board.piece_map()
         is_previous_checked = current_board.is_check()
 
         for index, piece in dict_of_pieces.items():
-            if piece.symbol() != "p" or chess.SQUARE_NAMES[index] != "e6":
-                continue
             if piece.symbol() == 'K' or piece.symbol() == 'k' \
                     or index == puzzle.moves[0].from_square \
                     or index == puzzle.moves[0].to_square:
@@ -154,17 +222,54 @@ class Regenerator:
             new_game = chess.pgn.Game()
             new_game.add_main_variation(puzzle.moves[0])
             new_game.setup(chess.Board(new_fen))
-            info = self.engine.analyse(new_game.next().board(), chess.engine.Limit(depth=20))
-            current_eval = info["score"]
+            yield Variant(index, piece, new_game.next())
 
-            new_puzzle = self.analyze_position(new_game.next(), current_eval, puzzle.moves, tier=10)
-            if isinstance(new_puzzle, Score):
-                continue
-            else:
-                new_moves = new_puzzle.moves
-                mainlines = puzzle.moves
-                puzzles.append(new_puzzle)
-        return puzzles
+    def evaluate_variant(self, variant: Variant, moves: List[Move]) -> Optional[Puzzle]:
+        info = self.engine.analyse(variant.node.board(), chess.engine.Limit(depth=20))
+        current_eval = info["score"]
+        new_puzzle = self.analyze_position(variant.node, current_eval, moves, tier=10)
+        return None if isinstance(new_puzzle, Score) else new_puzzle
+
+    def evaluate_on_idle(self, variant: Variant, moves: List[Move]) -> Tuple[Optional[Puzzle], float]:
+        regenerator = self.idle.get()
+        try:
+            start = time.time()
+            new_puzzle = regenerator.evaluate_variant(variant, moves)
+            return new_puzzle, time.time() - start
+        finally:
+            self.idle.put(regenerator)
+
+    def generate_new_puzzle(self, puzzle: Puzzle) -> Union[List[Puzzle], None]:
+        # create list of potentially removable pieces
+        # try removing each piece
+        # test each piece with analyze_position, on every engine of the pool at once
+        # compare main lines with the resultant puzzles, if equal, add to the list
+        # return the list
+        variants = self.variants(puzzle)
+        results: Dict[int, Optional[Puzzle]] = {}
+        self.timings = []
+
+        def collect(variant: Variant, new_puzzle: Optional[Puzzle], seconds: float) -> None:
+            logger.debug("Variant without {} on {}: {} in {:.2f}s".format(variant.piece.symbol(), chess.SQUARE_NAMES[variant.square], "puzzle" if new_puzzle else "nothing", seconds))
+            results[variant.square] = new_puzzle
+            self.timings.append((variant, seconds))
+
+        if self.executor:
+            futures = {self.executor.submit(self.evaluate_on_idle, variant, puzzle.moves): variant for variant in variants}
+            for future in as_completed(futures):
+                collect(futures[future], *future.result())
+        else:
+            for variant in variants:
+                collect(variant, *self.evaluate_on_idle(variant, puzzle.moves))
+
+        # in board order, whichever engine finished first
+        return [p for p in (results[variant.square] for variant in variants) if p]
+
+    def close(self) -> None:
+        if self.executor:
+            self.executor.shutdown()
+        for regenerator in [self] + self.helpers:
+            regenerator.engine.close()
 
     def analyze_position(self, node: ChildNode, current_eval: PovScore, moves: [Move], tier: int) -> Union[Puzzle, Score]:
 
@@ -218,16 +323,17 @@ class Regenerator:
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         prog='Regenerator.py',
-        description='takes a pgn file and produces chess puzzles')
-    parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
+        description='takes a lichess puzzle csv and produces new puzzles by removing pieces')
+    parser.add_argument("--file", "-f", help="input puzzle CSV, like lichess_db_puzzle.csv", required=True, metavar="FILE.csv")
+    parser.add_argument("--output", "-o", help="CSV the new puzzles are appended to", default="regenerated.csv")
+    parser.add_argument("--checkpoint", help="file of the source puzzles already regenerated, skipped when resuming", default="regenerated.done")
     parser.add_argument("--engine", "-e", help="analysis engine", default="./stockfish")
-    parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
-    parser.add_argument("--url", "-u", help="URL where to post puzzles", default="http://localhost:8000")
-    parser.add_argument("--token", help="Server secret token", default="changeme")
-    parser.add_argument("--skip", help="How many games to skip from the source", default="0")
+    parser.add_argument("--threads", "-t", help="count of cpu threads of each engine", default="1")
+    parser.add_argument("--engines", help="engines of each worker, evaluating the variants of a puzzle in parallel", default="1")
+    parser.add_argument("--workers", "-w", help="count of worker processes, each regenerating its own puzzles", default="4")
+    parser.add_argument("--max-variants", help="engine evaluations per source puzzle, the most relevant variants first, 0 for all", default="0")
+    parser.add_argument("--puzzles", help="how many source puzzles to regenerate in this run, 0 for all", default="0")
     parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
-    parser.add_argument("--parts", help="how many parts", default="8")
-    parser.add_argument("--part", help="which one of the parts", default="0")
 
     return parser.parse_args()
 
@@ -238,41 +344,23 @@ def make_engine(executable: str, threads: int) -> SimpleEngine:
     return engine
 
 
+def make_regenerator(executable: str, threads: int, engines: int = 1) -> Regenerator:
+    """
+    `engines` engines of `threads` threads each, evaluating the variants of a puzzle in parallel
+    """
+    return Regenerator(make_engine(executable, threads), [make_engine(executable, threads) for _ in range(engines - 1)])
+
+
 def open_file(file: str):
     if file.endswith(".zst"):
         return zstandard.open(file, "rt")
     return open(file)
 
-def main(file, lines):
-    engine = SimpleEngine.popen_uci(r"C:\Users\wangh\Downloads\stockfish-windows-x86-64-avx2\stockfish\stockfish-windows-x86-64-avx2.exe")
-    regenerator = Regenerator(engine)
-    count = 0
-    with open(file) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=',')
-        next(csv_reader)
-        for row in csv_reader:
-            id = row[0]
-
-            fen = row[1]
-            moves = [Move.from_uci(move) for move in row[2].split(" ")]
-            board = chess.Board(fen)
-            game = chess.pgn.Game()
-            game.setup(board)
-            puzzle = Puzzle(game, moves, 988888888888)
-            start = time.time()
-            anrs = regenerator.generate_new_puzzle(puzzle)
-            end = time.time()
-            print("-----------------------")
-            print(f"Now is the {id} puzzle")
-            print("The time used is: ", end - start)
-            print("the size of the generated new puzzles is: ", len(anrs))
-            print(anrs)
-
-            if count > 100:
-                count+=1
-                break
+def main() -> None:
+    from batch import run_batch
+    args = parse_args()
+    run_batch(args, version)
 
 
 if __name__ == "__main__":
-    main(r"C:\Users\wangh\Downloads\lichess_db_puzzle\lichess_db_puzzle.csv", 100)
-
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import csv
+import logging
+import os
+import queue
+import time
+import workerpool
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Set, TYPE_CHECKING
+from workerpool import worker_pool
+
+if TYPE_CHECKING:
+    from Regenerator import Regenerator
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_HEADER = ["PuzzleId", "FEN", "Moves", "Cp", "SourcePuzzleId", "RemovedPiece", "Seconds", "Version"]
+
+@dataclass
+class Source:
+    id: str
+    fen: str
+    moves: str # uci, the first one is the opponent's move leading to the puzzle
+
+@dataclass
+class SourceResult:
+    source: Source
+    rows: List[List[str]] = field(default_factory = list)
+    variants: int = 0
+    seconds: float = 0
+    error: Optional[str] = None
+
+
+class Checkpoint:
+    """
+    Append-only record of the source puzzles already regenerated, one tab separated line each:
+    version, puzzle id, variants evaluated, puzzles generated, seconds
+    """
+
+    def __init__(self, path: str, version: int) -> None:
+        self.path = path
+        self.version = version
+        self.done: Set[str] = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) >= 2 and fields[0] == str(version):
+                        self.done.add(fields[1])
+
+    def is_done(self, source: Source) -> bool:
+        return source.id in self.done
+
+    def record(self, result: SourceResult) -> None:
+        with open(self.path, "a") as f:
+            f.write(f"{self.version}\t{result.source.id}\t{result.variants}\t{len(result.rows)}\t{round(result.seconds, 1)}\n")
+        self.done.add(result.source.id)
+
+
+def read_sources(file: str) -> Iterator[Source]:
+    """
+    streams the puzzles of a lichess_db_puzzle.csv, possibly zstd compressed
+    """
+    from Regenerator import open_file
+    with open_file(file) as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield Source(row[0], row[1], row[2])
+
+
+def make_worker(args: argparse.Namespace) -> "Regenerator":
+    from Regenerator import make_regenerator, logger as regenerator_logger
+    regenerator_logger.setLevel(logger.level)
+    regenerator = make_regenerator(args.engine, int(args.threads), int(args.engines))
+    regenerator.max_variants = int(args.max_variants) or None
+    return regenerator
+
+def run_source(source: Source, version: int) -> SourceResult:
+    import chess
+    import chess.pgn
+    from chess import Move
+    from model import Puzzle
+    worker = workerpool.worker
+    assert worker
+    start = time.time()
+    try:
+        game = chess.pgn.Game()
+        game.setup(chess.Board(source.fen))
+        puzzles = worker.generate_new_puzzle(Puzzle(game, [Move.from_uci(m) for m in source.moves.split()], 0)) or []
+        timings = {id(variant.node): (variant, seconds) for variant, seconds in worker.timings}
+        rows = []
+        for puzzle in puzzles:
+            variant, seconds = timings[id(puzzle.node)]
+            square = chess.SQUARE_NAMES[variant.square]
+            rows.append([
+                f"{source.id}-{square}",
+                puzzle.node.parent.board().fen(),
+                " ".join(move.uci() for move in [puzzle.node.move] + puzzle.moves),
+                str(puzzle.cp),
+                source.id,
+                variant.piece.symbol() + square,
+                str(round(seconds, 1)),
+                str(version),
+            ])
+        return SourceResult(source, rows, len(worker.timings), time.time() - start)
+    except Exception as e:
+        return SourceResult(source, [], 0, time.time() - start, str(e))
+
+
+def run_batch(args: argparse.Namespace, version: int) -> None:
+    logger.setLevel(logging.DEBUG if args.verbose == 2 else logging.INFO)
+    checkpoint = Checkpoint(args.checkpoint, version)
+    workers = int(args.workers)
+    limit = int(args.puzzles)
+    logger.info(f"v{version} regenerating {args.file} with {workers} workers, {len(checkpoint.done)} puzzles already done")
+
+    results: "queue.Queue[SourceResult]" = queue.Queue()
+    # sources waiting in the pool, the csv is only read as fast as it is processed
+    in_flight = 2 * workers
+    pending = 0
+    done = 0
+    generated = 0
+    failed = 0
+    start = time.time()
+    new_file = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+    with open(args.output, "a", newline = "") as out, \
+            worker_pool(workers, make_worker, args) as pool:
+        writer = csv.writer(out)
+        if new_file:
+            writer.writerow(OUTPUT_HEADER)
+
+        def collect() -> None:
+            nonlocal pending, done, generated, failed
+            result = results.get()
+            pending -= 1
+            if result.error:
+                failed += 1
+                logger.error(f"Puzzle {result.source.id} failed: {result.error}")
+                return
+            # puzzles first: a crash in between regenerates the source again rather than losing its puzzles
+            writer.writerows(result.rows)
+            out.flush()
+            checkpoint.record(result)
+            done += 1
+            generated += len(result.rows)
+            if done % 100 == 0:
+                elapsed = time.time() - start
+                logger.info(f"{done} puzzles regenerated into {generated} new ones, {failed} failed, {round(done / elapsed * 3600)} puzzles/hour")
+
+        for source in read_sources(args.file):
+            if checkpoint.is_done(source):
+                continue
+            if limit and done + pending + failed >= limit:
+                break
+            pool.apply_async(
+                run_source, (source, version),
+                callback = results.put,
+                error_callback = lambda e, source = source: results.put(SourceResult(source, error = str(e)))
+            )
+            pending += 1
+            while pending >= in_flight:
+                collect()
+        while pending:
+            collect()
+    logger.info(f"Done: {done} puzzles regenerated into {generated} new ones in {args.output}, {failed} failed")
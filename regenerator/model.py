@@ -1,5 +1,5 @@
 from chess.pgn import GameNode, ChildNode
-from chess import Move, Color
+from chess import Move, Color, Piece, Square
 from chess.engine import Score
 from dataclasses import dataclass
 from typing import Tuple, List, Optional
@@ -27,3 +27,10 @@ class NextMovePair:
     winner: Color
     best: EngineMove
     second: Optional[EngineMove]
+
+@dataclass
+class Variant:
+    square: Square
+    piece: Piece
+    # after the first move of the puzzle, in the position without the piece
+    node: ChildNode
@@ -1,6 +1,12 @@
 import unittest
 import logging
+import argparse
+import csv
+import os
+import tempfile
 import chess
+import batch
+from unittest import mock
 from model import Puzzle
 from Regenerator import logger
 from server import Server
@@ -8,7 +14,129 @@ from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess import Move, Color, Board, WHITE, BLACK
 from chess.pgn import Game, GameNode
 from typing import List, Optional, Tuple, Literal, Union
-from Regenerator import Regenerator, Server, make_engine
+from Regenerator import Regenerator, make_engine, shallow_limit
+from util import influence, replays
+
+
+class TestVariants(unittest.TestCase):
+
+    def test_influence(self) -> None:
+        board = Board("6k1/5ppp/4n3/8/8/8/P4PPP/3R2K1 w - - 0 1")
+        moves = [Move.from_uci("d1d8"), Move.from_uci("e6f8"), Move.from_uci("d8f8")]
+        # attacks d8 and stands on d1
+        self.assertEqual(influence(board, chess.D1, moves), 2)
+        # attacks d8 and f8, stands on e6
+        self.assertEqual(influence(board, chess.E6, moves), 3)
+        self.assertEqual(influence(board, chess.A2, moves), 0)
+
+    def test_replays(self) -> None:
+        board = Board("6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1")
+        moves = [Move.from_uci("d1d8")]
+        self.assertTrue(replays(board, moves))
+        board.set_piece_at(chess.D5, chess.Piece(chess.KNIGHT, BLACK))
+        self.assertFalse(replays(board, moves))
+
+
+class TestVariantSelection(unittest.TestCase):
+
+    def test_cut_variants_stay_unseen(self) -> None:
+        game = Game.from_board(Board("6k1/5ppp/4n3/B7/8/8/P4PPP/3R2K1 b - - 0 1"))
+        puzzle = Puzzle(game, [Move.from_uci("g8h8"), Move.from_uci("d1d8"), Move.from_uci("e6f8"), Move.from_uci("d8f8")], 0)
+        regenerator = Regenerator(None) # type: ignore
+        every = regenerator.variants(puzzle)
+        self.assertGreater(len(every), 1)
+        regenerator = Regenerator(None) # type: ignore
+        regenerator.max_variants = 1
+        first = regenerator.variants(puzzle)
+        self.assertEqual([v.square for v in first], [every[0].square])
+        regenerator.max_variants = None
+        self.assertEqual([v.square for v in regenerator.variants(puzzle)], [v.square for v in every[1:]])
+
+
+class ScriptedEngine:
+    """
+    answers each search from the best move and the score it would give to any move
+    """
+
+    def __init__(self, best: str, scores: dict) -> None:
+        self.best = Move.from_uci(best)
+        self.scores = scores
+        self.limits: List[chess.engine.Limit] = []
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, root_moves: Optional[List[Move]] = None, **kwargs) -> chess.engine.InfoDict:
+        self.limits.append(limit)
+        move = root_moves[0] if root_moves else self.best
+        return {"pv": [move], "score": PovScore(Cp(self.scores[move.uci()]), board.turn)}
+
+
+class TestDivergence(unittest.TestCase):
+
+    def test_diverges(self) -> None:
+        board = Board("6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1")
+        engine = ScriptedEngine("d1d8", {"d1d8": 1000, "d1d2": 0, "g1f1": 950})
+        regenerator = Regenerator(engine) # type: ignore
+        self.assertTrue(regenerator.diverges(board, Move.from_uci("d1d2")))
+        self.assertFalse(regenerator.diverges(board, Move.from_uci("d1d8")))
+        # close enough for the full search to decide
+        self.assertFalse(regenerator.diverges(board, Move.from_uci("g1f1")))
+        self.assertTrue(all(limit == shallow_limit for limit in engine.limits))
+
+    def test_early_abort(self) -> None:
+        engine = ScriptedEngine("d1d8", {"d1d8": 1000, "d1d2": 0})
+        game = Game.from_board(Board("6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1"))
+        solution = Regenerator(engine).cook_advantage(game, WHITE, [Move.from_uci("g7g6"), Move.from_uci("d1d2")], 1) # type: ignore
+        self.assertIsNone(solution)
+        self.assertEqual(len(engine.limits), 2)
+
+
+class InlinePool:
+    """
+    multiprocessing.Pool running each source as soon as it is submitted, in the calling process
+    """
+
+    def __init__(self, processes: int, initializer = None, initargs = ()) -> None:
+        pass
+
+    def __enter__(self) -> "InlinePool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def apply_async(self, func, args, callback, error_callback) -> None:
+        callback(func(*args))
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_resume(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            file = os.path.join(dir, "puzzles.csv")
+            with open(file, "w") as f:
+                f.write("PuzzleId,FEN,Moves\n")
+                for i in range(10):
+                    f.write(f"p{i},8/8/8/8/8/8/8/8 w - - 0 1,a1a2\n")
+            args = argparse.Namespace(file = file, output = os.path.join(dir, "out.csv"), checkpoint = os.path.join(dir, "checkpoint.tsv"), workers = "2", puzzles = "0", verbose = None)
+            ran: List[str] = []
+            interrupt = 6
+            def run_source(source: batch.Source, version: int) -> batch.SourceResult:
+                if len(ran) == interrupt:
+                    raise KeyboardInterrupt
+                ran.append(source.id)
+                # two new puzzles out of each source
+                return batch.SourceResult(source, [[f"{source.id}-{square}", source.fen, source.moves, "0", source.id, "", "1", str(version)] for square in ["a1", "h8"]], 2, 1)
+            with mock.patch("workerpool.multiprocessing.Pool", InlinePool), mock.patch("batch.run_source", run_source):
+                with self.assertRaises(KeyboardInterrupt):
+                    batch.run_batch(args, 1)
+                interrupt = -1
+                batch.run_batch(args, 1)
+            # the sources ran but not collected before the interrupt run again
+            self.assertGreater(len(ran), 10)
+            with open(args.output) as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows[0], batch.OUTPUT_HEADER)
+            ids = [row[0] for row in rows[1:]]
+            self.assertEqual(sorted(ids), sorted(f"p{i}-{square}" for i in range(10) for square in ["a1", "h8"]))
 
 
 class TestGenerator(unittest.TestCase):
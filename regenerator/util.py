@@ -3,10 +3,10 @@ import math
 import chess
 import chess.engine
 from model import EngineMove, NextMovePair
-from chess import Color, Board
+from chess import Color, Board, Move, Square, WHITE, BLACK
 from chess.pgn import GameNode
 from chess.engine import SimpleEngine, Score
-from typing import Optional
+from typing import List, Optional
 
 nps = []
 
@@ -69,6 +69,40 @@ def time_control_tier(line: str) -> Optional[int]:
     except:
         return 0
     
+def solution_squares(moves: List[Move]) -> chess.SquareSet:
+    squares = chess.SquareSet()
+    for move in moves:
+        squares.add(move.from_square)
+        squares.add(move.to_square)
+    return squares
+
+def influence(board: Board, square: Square, moves: List[Move]) -> int:
+    """
+    how many squares of the solution `moves` have their attackers or defenders changed by removing
+    the piece on `square`: the squares it attacks, and the ones behind it on the lines it blocks.
+    A piece standing on the solution path counts once more.
+    """
+    without = board.copy(stack = False)
+    without.remove_piece_at(square)
+    squares = solution_squares(moves)
+    changed = sum(
+        1 for target in squares
+        if board.attackers(WHITE, target) != without.attackers(WHITE, target)
+        or board.attackers(BLACK, target) != without.attackers(BLACK, target)
+    )
+    return changed + (1 if square in squares else 0)
+
+def replays(board: Board, moves: List[Move]) -> bool:
+    """
+    whether the whole solution is still legal from `board`
+    """
+    board = board.copy(stack = False)
+    for move in moves:
+        if not board.is_legal(move):
+            return False
+        board.push(move)
+    return True
+
 def count_mates(board:chess.Board) -> int:
     mates = 0
     for move in board.legal_moves:
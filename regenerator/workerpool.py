@@ -0,0 +1 @@
+../generator/workerpool.py
\ No newline at end of file
@@ -0,0 +1 @@
+../generator/profiler.py
\ No newline at end of file
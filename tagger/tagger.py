@@ -11,6 +11,7 @@ from model import Puzzle, TagKind
 import cook
 import chess.engine
 from zugzwang import zugzwang
+from profiler import Profiler
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%m/%d %H:%M')
@@ -32,11 +33,17 @@ if __name__ == "__main__":
     parser.add_argument("--all", "-a", help="don't skip existing", action="store_true")
     parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
     parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
+    parser.add_argument("--profile-control", help="sample stacks while this file exists, in addition to SIGUSR1 toggling", metavar="FILE")
     args = parser.parse_args()
 
+    # each cruncher process installs its own, SIGUSR1 only toggles the process it is sent to
+    profiler = Profiler(control_file = args.profile_control)
+    profiler.install()
+
     if args.zug:
         threads = int(args.threads)
         def cruncher(thread_id: int):
+            profiler.install()
             db = pymongo.MongoClient()['puzzler']
             round_coll = db['puzzle2_round']
             play_coll = db['puzzle2_puzzle']
@@ -74,6 +81,7 @@ if __name__ == "__main__":
     if args.bad_mate:
         threads = int(args.threads)
         def cruncher(thread_id: int):
+            profiler.install()
             db = pymongo.MongoClient()['puzzler']
             bad_coll = db['puzzle2_bad_maybe']
             play_coll = db['puzzle2_puzzle']
@@ -105,6 +113,7 @@ if __name__ == "__main__":
     threads = int(args.threads)
 
     def cruncher(thread_id: int):
+        profiler.install()
         db = pymongo.MongoClient()['puzzler']
         play_coll = db['puzzle2_puzzle']
         round_coll = db['puzzle2_round']